@@ -109,6 +109,10 @@ class Brain(object):
 
     """
 
+    #data are read from _data_file the first time they're accessed (see supereeg.load's lazy option)
+    _data = None
+    _data_file = None
+
     def __init__(self, data=None, locs=None, sessions=None, sample_rate=None,
                  meta=None, date_created=None, label=None, kurtosis=None,
                  kurtosis_threshold=10, minimum_voxel_size=3, maximum_voxel_size=20,
@@ -217,6 +221,20 @@ class Brain(object):
             self.minimum_voxel_size = minimum_voxel_size
             self.maximum_voxel_size = maximum_voxel_size
 
+    @property
+    def data(self):
+        """
+        Samples x electrodes dataframe containing the EEG data.  Lazily loaded brain objects read their data from
+        disk the first time this attribute is accessed.
+        """
+        if (self._data is None) and not (self._data_file is None):
+            self._data = pd.DataFrame(dd.io.load(self._data_file, group='/data'))
+        return self._data
+
+    @data.setter
+    def data(self, data):
+        self._data = data
+
     def __getitem__(self, slice):
         if isinstance(slice, tuple):
             timeslice, locslice = slice
@@ -249,7 +267,7 @@ class Brain(object):
             self.filter_inds = np.ones((1, self.locs.shape[0]), dtype=np.bool)[0] #TODO: check this
 
     def update_info(self):
-        self.n_elecs = self.data.shape[1] # needs to be calculated by sessions
+        self.n_elecs = self.locs.shape[0] # needs to be calculated by sessions
         self.n_sessions = len(self.sessions.unique())
         ## not entirely sure if try/except necessary and not if/else
         try:
@@ -289,7 +307,7 @@ class Brain(object):
         if self.filter == 'kurtosis':
             x['kurtosis'] = x['kurtosis'][x['kurtosis'] <= x['kurtosis_threshold']]
 
-        for key in ['n_subs', 'n_elecs', 'n_sessions', 'dur', 'filter_inds']:
+        for key in ['n_subs', 'n_elecs', 'n_sessions', 'dur', 'filter_inds', '_data', '_data_file']:
             if key in x.keys():
                 x.pop(key)
 
@@ -339,7 +357,7 @@ class Brain(object):
 
         """
         if sample_inds is None:
-            sample_inds = list(self.get_data().index)
+            sample_inds = list(range(self.sessions.shape[0]))
         if loc_inds is None:
             loc_inds = list(self.get_locs().index)
         if isinstance(sample_inds, int):
@@ -347,7 +365,14 @@ class Brain(object):
         if isinstance(loc_inds, int):
             loc_inds = [loc_inds]
 
-        data = self.get_data().iloc[sample_inds, loc_inds].reset_index(drop=True)
+        if (self._data is None) and not (self._data_file is None):
+            #only read the requested samples from disk
+            samples, rows = np.unique(np.arange(self.sessions.shape[0])[sample_inds], return_inverse=True)
+            data = np.atleast_2d(dd.io.load(self._data_file, group='/data', sel=dd.aslice[samples.tolist(), :]))[rows]
+            self.update_filter_inds()
+            data = pd.DataFrame(data).iloc[:, self.filter_inds.ravel()].iloc[:, loc_inds].reset_index(drop=True)
+        else:
+            data = self.get_data().iloc[sample_inds, loc_inds].reset_index(drop=True)
         sessions = self.sessions.iloc[sample_inds]
         kurtosis = self.kurtosis[self.get_locs().index[loc_inds]]
         if self.sample_rate:
@@ -636,3 +661,98 @@ class Brain(object):
             fname += '.bo'
 
         dd.io.save(fname, bo, compression=compression)
+
+
+def _save_chunks(fname, chunks, n_samples, locs, sessions, sample_rate, label=None, meta=None, compression='blosc'):
+    """
+    Save a brain object to a .bo file one chunk of data at a time
+
+    Only one chunk of data needs to be held in memory at a time.  The file has the same fields as the files written
+    by Brain.save; each electrode's kurtosis is computed in the same pass, from running sums of its moments.
+
+    Parameters
+    ----------
+    fname : str
+        A name for the file.  If the file extension (.bo) is not specified, it will be appended.
+
+    chunks : iterable
+        Yields (session, sample indices, data) tuples, where data is a samples x electrodes array
+
+    n_samples : int
+        Total number of samples
+
+    locs, sessions, sample_rate, label, meta :
+        See Brain
+
+    compression : str
+        The kind of compression to use (see Brain.save)
+
+    Returns
+    ----------
+    fname : str
+        The name of the saved file
+    """
+    import tables
+
+    if not isinstance(locs, pd.DataFrame):
+        locs = pd.DataFrame(locs, columns=['x', 'y', 'z'])
+    if label is None:
+        label = len(locs) * ['observed']
+    if meta is None:
+        meta = {}
+    if fname[-3:] != '.bo':
+        fname += '.bo'
+
+    bo = {
+        'locs': locs,
+        'sessions': sessions,
+        'sample_rate': sample_rate,
+        'kurtosis_threshold': 10,
+        'meta': meta,
+        'date_created': time.strftime("%c"),
+        'minimum_voxel_size': 3,
+        'maximum_voxel_size': 20,
+        'label': label,
+        'filter': None,
+    }
+    dd.io.save(fname, bo, compression=compression)
+
+    if compression:
+        filters = tables.Filters(complevel=9, complib='blosc' if compression in (True, 'default') else compression,
+                                 shuffle=True)
+    else:
+        filters = None
+
+    #per session: number of samples and the sums of the first four powers of each electrode's data
+    moments = {}
+    with tables.open_file(fname, 'a') as f:
+        data = f.create_carray(f.root, 'data', atom=tables.Float64Atom(), shape=(n_samples, locs.shape[0]),
+                               filters=filters)
+        for session, inds, block in chunks:
+            inds = np.asarray(inds)
+            block = np.asarray(block, dtype=np.float64)
+            if np.all(np.diff(inds) == 1):
+                data[inds[0]:(inds[-1] + 1)] = block
+            else:
+                for i, x in zip(inds, block):
+                    data[i] = x
+
+            sums = np.vstack([np.sum(block ** p, axis=0) for p in range(1, 5)])
+            if session in moments:
+                moments[session][0] += len(inds)
+                moments[session][1] += sums
+            else:
+                moments[session] = [len(inds), sums]
+
+        #maximum kurtosis across sessions (as in _kurt_vals)
+        kurtosis = []
+        for n, sums in moments.values():
+            mu, e2, e3, e4 = sums / n
+            with np.errstate(divide='ignore', invalid='ignore'):
+                kurtosis.append(np.divide(e4 - 4 * mu * e3 + 6 * mu ** 2 * e2 - 3 * mu ** 4, (e2 - mu ** 2) ** 2) - 3)
+        if len(kurtosis) > 0:
+            kurtosis = np.max(np.vstack(kurtosis), axis=0)
+        else:
+            kurtosis = np.zeros(locs.shape[0])
+        f.create_array(f.root, 'kurtosis', kurtosis)
+    return fname
@@ -0,0 +1,90 @@
+from __future__ import division
+from __future__ import print_function
+from collections import OrderedDict
+
+
+class LRUCache(object):
+    """
+    Least recently used (LRU) cache for the supereeg package
+
+    Holds up to maxsize items (and, optionally, up to maxbytes bytes of numpy arrays).  Once the cache is full, adding
+    an item discards the items that were least recently added or retrieved.
+
+    Parameters
+    ----------
+    maxsize : int or None
+        Maximum number of items to keep (default: 8).  If None, the number of items isn't limited.
+    maxbytes : int or None
+        Maximum total size (in bytes) of the numpy arrays held by the cache's items (an item may be an array or a
+        tuple of arrays).  Items that are larger than maxbytes are not cached.  If None (default), the size of the
+        items isn't limited.
+
+    Attributes
+    ----------
+    maxsize : int or None
+        Maximum number of items to keep
+    maxbytes : int or None
+        Maximum total size of the cached items
+    nbytes : int
+        Current total size of the cached items
+    """
+    def __init__(self, maxsize=8, maxbytes=None):
+        self.maxsize = maxsize
+        self.maxbytes = maxbytes
+        self.nbytes = 0
+        self._items = OrderedDict()
+        self._sizes = {}
+
+    def __contains__(self, key):
+        return key in self._items
+
+    def __len__(self):
+        return len(self._items)
+
+    def get(self, key, default=None):
+        """
+        Returns the item stored under key (and marks it as the most recently used item), or default if there is no
+        such item
+        """
+        if not (key in self._items):
+            return default
+        value = self._items.pop(key)
+        self._items[key] = value
+        return value
+
+    def put(self, key, value):
+        """
+        Stores value under key, discarding the least recently used items if the cache is full
+        """
+        if key in self._items:
+            self._discard(key)
+        size = _nbytes(value)
+        if not (self.maxbytes is None) and (size > self.maxbytes):
+            return
+        self._items[key] = value
+        self._sizes[key] = size
+        self.nbytes += size
+        while (not (self.maxsize is None) and (len(self._items) > max(self.maxsize, 0))) or \
+                (not (self.maxbytes is None) and (self.nbytes > self.maxbytes)):
+            self._discard(next(iter(self._items)))
+
+    def clear(self):
+        """
+        Removes every item from the cache
+        """
+        self._items.clear()
+        self._sizes.clear()
+        self.nbytes = 0
+
+    def _discard(self, key):
+        self._items.pop(key)
+        self.nbytes -= self._sizes.pop(key)
+
+
+def _nbytes(value):
+    """
+    Total size (in bytes) of the numpy arrays in value (an array, or a tuple or list of arrays)
+    """
+    if isinstance(value, (tuple, list)):
+        return sum(_nbytes(x) for x in value)
+    return int(getattr(value, 'nbytes', 0))
@@ -10,6 +10,11 @@ from __future__ import print_function
 
 import copy
 import os
+import glob
+import hashlib
+import threading
+import weakref
+import six
 import numpy.matlib as mat
 import matplotlib.pyplot as plt
 import pandas as pd
@@ -18,7 +23,10 @@ import imageio
 import nibabel as nib
 import hypertools as hyp
 import shutil
+import tempfile
 import warnings
+import deepdish as dd
+from six.moves import queue
 
 
 from nilearn import plotting as ni_plt
@@ -28,14 +36,20 @@ from scipy.stats import kurtosis, zscore, pearsonr
 from scipy.spatial.distance import pdist
 from scipy.spatial.distance import cdist
 from scipy.spatial.distance import squareform
+from scipy.spatial import cKDTree
+from scipy import sparse
 from scipy.special import logsumexp
 from scipy import linalg
 from scipy.ndimage.interpolation import zoom
+from joblib import Parallel, delayed, cpu_count
 try:
     from itertools import zip_longest
 except:
     from itertools import izip_longest as zip_longest
 
+#maximum number of elements in the working arrays used to blur each block of location pairs (see _blur_corrmat)
+_BLUR_BUFFER_SIZE = 2 ** 22
+
 
 def _std(res=None):
     """
@@ -330,6 +344,48 @@ def _log_rbf(to_coords, from_coords, width=20):
     return weights
 
 
+def _sparse_rbf(to_coords, from_coords, width=20, tol=1e-10):
+    """
+    Radial basis function, truncated to nearby locations
+
+    Parameters
+    ----------
+    to_coords : ndarray
+        Series of all coordinates (one per row) - R_full
+
+    from_coords : ndarray
+        Series of subject's coordinates (one per row) - R_subj
+
+    width : positive scalar
+        Radius
+
+    tol : positive scalar
+        Smallest weight to keep (default: 1e-10).  Weights below tol are dropped, which corresponds to ignoring
+        locations more than sqrt(-width * log(tol)) away.
+
+    Returns
+    ----------
+    results : scipy.sparse.csr_matrix
+        Sparse matrix of (non-log) rbf weights for each subject coordinate for all coordinates
+
+    """
+    assert np.isscalar(width), 'RBF width must be a scalar'
+    assert width > 0, 'RBF width must be positive'
+    assert 0 < tol < 1, 'RBF weight tolerance must be between 0 and 1'
+
+    to_coords = np.atleast_2d(np.asarray(to_coords, dtype=np.float64))
+    from_coords = np.atleast_2d(np.asarray(from_coords, dtype=np.float64))
+    radius = np.sqrt(-float(width) * np.log(tol))
+
+    neighbors = cKDTree(from_coords).query_ball_point(to_coords, radius)
+    indptr = np.cumsum([0] + [len(x) for x in neighbors])
+    indices = np.array([i for x in neighbors for i in sorted(x)], dtype=np.int64)
+    rows = np.repeat(np.arange(to_coords.shape[0]), np.diff(indptr))
+    dists = np.sum((to_coords[rows, :] - from_coords[indices, :]) ** 2, axis=1)
+    weights = np.exp(-dists / float(width))
+    return sparse.csr_matrix((weights, indices, indptr), shape=(to_coords.shape[0], from_coords.shape[0]))
+
+
 def tal2mni(r):
     """
     Convert coordinates (electrode locations) from Talairach to MNI space
@@ -359,7 +415,8 @@ def tal2mni(r):
     return np.round(inpoints[0:3, :].T, decimals=2)
 
 
-def _blur_corrmat(Z, weights):
+def _blur_corrmat(Z, weights, method='exact', block_size=None, n_jobs=1, memmap_dir=None, source_inds=None,
+                  dtype=np.float64, packed=False):
     """
     Gets full correlation matrix
 
@@ -368,12 +425,55 @@ def _blur_corrmat(Z, weights):
     Z : Numpy array
         Subject's Fisher z-transformed correlation matrix
 
-    weights : Numpy array
-        Weights matrix calculated using _log_rbf function matrix
+    weights : Numpy array or scipy.sparse matrix
+        Weights matrix calculated using _log_rbf function matrix, or a (truncated) sparse weights matrix calculated
+        using _sparse_rbf.  Sparse weights are always blurred using the 'sparse' method.
+
+    method : 'exact', 'factorized' or 'sparse'
+        How to blur the correlation matrix:
+
+            'exact' (default) : sums over every pair of source locations, for each pair of target locations, in log
+            space.  Cost scales with the squares of both the number of target and the number of source locations.
+
+            'factorized' : computes the same sums as max-shifted matrix products (W * Z * W^T), at a cost that scales
+            with (targets x sources^2 + targets^2 x sources).  Pairs whose sums underflow after shifting (e.g. two
+            target locations whose nearest source location is the same isolated electrode) are detected and
+            recomputed using the exact method.
+
+            'sparse' : like 'factorized', but only sums over source locations whose (truncated) weights are non-zero,
+            so the cost scales with the number of nearby source locations rather than the total number of source
+            locations.  Target pairs without any nearby source locations come out as -inf.
+
+    block_size : int or None
+        Number of (upper triangle) location pairs to blur per vectorized block.  Peak memory scales with block_size
+        times the number of source location pairs, so smaller blocks use less memory.  If None (default), the block
+        size is chosen so that each block holds about _BLUR_BUFFER_SIZE elements.
+
+    n_jobs : int
+        Number of worker processes used to blur blocks in parallel (default: 1).  -1 uses every available core.  Each
+        block contains the same number of location pairs, and workers write their blocks directly into shared
+        (memory-mapped) output arrays.
+
+    memmap_dir : str or None
+        If specified, the numerator and denominator are written (one block at a time) to new .npy files in this
+        directory and returned as memmaps of those files, so the expanded matrices never need to fit in memory.  If
+        None (default), the results are returned as in-memory arrays.
+
+    source_inds : Numpy array or None
+        Optional array (of length weights.shape[0]) giving, for each target location, the index of the identical
+        source location, or -1 for target locations that aren't source locations (see _loc_index).  Pairs of target
+        locations that are both source locations are copied straight from Z, and only pairs that involve at least one
+        new location are blurred.  This makes adding a few locations to a large model much cheaper.  If None
+        (default), the exact matches are looked up in the weights matrix (see _match_index).
+
+    dtype : Numpy floating point type
+        Type used to store the denominator (default: np.float64).  The numerator is stored using the matching complex
+        type (e.g. np.float32 gives a complex64 numerator and halves the memory needed for the results).  Blurring
+        itself is always done in double precision.
 
-    mode : str
-        Specifies whether to compute over all elecs (fit mode) or just new elecs
-        (predict mode)
+    packed : bool
+        If True, the numerator and denominator are returned as packed upper triangles (see _pack_triu), which take
+        about half as much memory as the full (symmetric) matrices.  (Default: False)
 
     Returns
     ----------
@@ -382,60 +482,644 @@ def _blur_corrmat(Z, weights):
     denominator : Numpy array
         Denominator for the expanded correlation matrix
     """
-    #import seaborn as sns
-    #import matplotlib.pyplot as plt
+    n = weights.shape[0]
+    if sparse.issparse(weights):
+        method = 'sparse'
+    blur = _blur_setup(Z, weights, method=method)
+
+    if block_size is None:
+        if method == 'exact':
+            block_size = max(1, _BLUR_BUFFER_SIZE // max(len(blur['src_rows']), 1))
+        else:
+            block_size = max(1, _BLUR_BUFFER_SIZE // max(Z.shape[0], 1))
+
+    if source_inds is None:
+        source_inds = np.where(blur['match_src'] >= 0, blur['match_src'], -1)
+    else:
+        source_inds = np.asarray(source_inds)
+    if not np.any(source_inds >= 0):
+        source_inds = None
+
+    #only the target locations that are blurred need their (factorized or sparse) matrix products
+    if method != 'exact':
+        if source_inds is None:
+            _blur_products(blur, np.arange(n))
+        else:
+            _blur_products(blur, np.where(source_inds < 0)[0])
+
+    if source_inds is None:
+        n_pairs = n * (n - 1) // 2
+    else:
+        n_pairs = _new_pairs(source_inds < 0)
+    if n_jobs < 0:
+        n_jobs = max(1, cpu_count() + 1 + n_jobs)
+
+    def pair_blocks(block_size):
+        for start in range(0, n_pairs, block_size):
+            stop = min(start + block_size, n_pairs)
+            if source_inds is None:
+                yield _triu_pairs(n, start, stop)
+            else:
+                yield _new_pairs(source_inds < 0, start, stop)
+
+    #the upper triangle of K_pos (positive part of the numerator) goes into numerator.real, the upper triangle of K_neg
+    #(negative part of the numerator) goes into numerator.imag, and the upper triangle of W goes into the denominator.
+    #the diagonal stays at 0, and the lower triangles are filled in at the end.
+    complex_dtype = np.result_type(dtype, np.complex64)
+    if packed:
+        shape = (n * (n + 1) // 2,)
+    else:
+        shape = (n, n)
+    if not (memmap_dir is None):
+        numerator = _open_memmap(memmap_dir, 'numerator', complex_dtype, shape)
+        denominator = _open_memmap(memmap_dir, 'denominator', dtype, shape)
+    elif n_jobs == 1:
+        numerator = np.zeros(shape, dtype=complex_dtype)
+        denominator = np.zeros(shape, dtype=dtype)
+
+    if n_jobs == 1:
+        if not (source_inds is None):
+            _copy_known(Z, source_inds, numerator)
+        for rows, cols in pair_blocks(block_size):
+            _blur_block(blur, rows, cols, numerator, denominator)
+    else:
+        #make sure there's at least one block per worker
+        block_size = max(1, min(block_size, -(-n_pairs // n_jobs)))
+
+        #workers write their blocks straight into memory-mapped outputs (which are shared by all of the workers)
+        tmpdir = None
+        if memmap_dir is None:
+            tmpdir = tempfile.mkdtemp()
+            numerator = _open_memmap(tmpdir, 'numerator', complex_dtype, shape)
+            denominator = _open_memmap(tmpdir, 'denominator', dtype, shape)
+        try:
+            if not (source_inds is None):
+                _copy_known(Z, source_inds, numerator)
+            Parallel(n_jobs=n_jobs)(delayed(_blur_block)(blur, rows, cols, numerator, denominator)
+                                    for rows, cols in pair_blocks(block_size))
+            if not (tmpdir is None):
+                numerator = np.array(numerator)
+                denominator = np.array(denominator)
+        finally:
+            if not (tmpdir is None):
+                shutil.rmtree(tmpdir, ignore_errors=True)
+
+    if not packed:
+        _symmetrize(numerator)
+        _symmetrize(denominator)
+    if not (memmap_dir is None):
+        numerator.flush()
+        denominator.flush()
+    return numerator, denominator
+
+
+def _blur_block(blur, rows, cols, numerator, denominator):
+    """
+    Blur one block of (upper triangle) location pairs and write the results into the (full or packed) numerator and
+    denominator
+    """
+    K_pos, K_neg, W = _blur_pairs(blur, rows, cols)
+    if numerator.ndim == 1:
+        inds = _packed_index(_packed_n(numerator.shape[0]), rows, cols)
+    else:
+        inds = (rows, cols)
+    numerator.real[inds] = K_pos
+    numerator.imag[inds] = K_neg
+    denominator[inds] = W
+
+
+def _new_pairs(is_new, start=None, stop=None):
+    """
+    Get the row and column indices of a range of the upper triangle location pairs that involve at least one new
+    location (in the same order as _triu_pairs)
+
+    Parameters
+    ----------
+    is_new : Numpy array
+        Boolean array with one entry per location (True for new locations)
+
+    start, stop : int or None
+        Range of pairs to get.  If both are None (default), the number of pairs is returned instead.
+
+    Returns
+    ----------
+    rows, cols : Numpy arrays
+        Row and column indices of each pair (cols > rows), or the total number of pairs
+    """
+    n = len(is_new)
+    new_inds = np.where(is_new)[0]
+
+    #row x pairs with every later location if x is new, and otherwise only with the later new locations
+    first_new = np.searchsorted(new_inds, np.arange(n), side='right')
+    counts = np.where(is_new, n - 1 - np.arange(n), len(new_inds) - first_new)
+    if start is None and stop is None:
+        return int(np.sum(counts))
+
+    row_starts = np.concatenate([[0], np.cumsum(counts)])
+    pairs = np.arange(start, stop)
+    rows = np.searchsorted(row_starts, pairs, side='right') - 1
+    offsets = pairs - row_starts[rows]
+    cols = np.where(is_new[rows], rows + 1 + offsets, new_inds[np.minimum(first_new[rows] + offsets, len(new_inds) - 1)])
+    return rows, cols
+
+
+def _copy_known(Z, source_inds, numerator, block_size=None):
+    """
+    Copy the (off-diagonal) correlations between target locations that are also source locations straight from Z into
+    the (full or packed) numerator (their denominators are 0).  Rows are copied in blocks, so memory-mapped numerators
+    are supported.
+    """
+    known = np.where(source_inds >= 0)[0]
+    if block_size is None:
+        block_size = max(1, _BLUR_BUFFER_SIZE // max(len(known), 1))
+    for start in range(0, len(known), block_size):
+        rows = known[start:start + block_size]
+        K_pos, K_neg = _log_match_values(Z[source_inds[rows], :][:, source_inds[known]])
+        if numerator.ndim == 1:
+            #packed numerators only hold the upper triangle (and the diagonal stays at 0)
+            x, y = np.meshgrid(rows, known, indexing='ij')
+            upper = y > x
+            inds = _packed_index(len(source_inds), x[upper], y[upper])
+            numerator.real[inds] = K_pos[upper]
+            numerator.imag[inds] = K_neg[upper]
+        else:
+            numerator.real[np.ix_(rows, known)] = K_pos
+            numerator.imag[np.ix_(rows, known)] = K_neg
+            numerator[rows, rows] = 0
+
+
+def _symmetrize(X, block_size=None):
+    """
+    Copy the upper triangle of the square matrix X into its lower triangle (in place), one block of rows at a time
+
+    Parameters
+    ----------
+    X : Numpy array or memmap
+        Square matrix to symmetrize
+
+    block_size : int or None
+        Number of rows per block.  If None (default), each block holds about _BLUR_BUFFER_SIZE elements.
+    """
+    n = X.shape[0]
+    if block_size is None:
+        block_size = max(1, _BLUR_BUFFER_SIZE // max(n, 1))
+
+    for start in range(0, n, block_size):
+        stop = min(start + block_size, n)
+        X[start:stop, :start] = X[:start, start:stop].T
+
+        diag_block = X[start:stop, start:stop]
+        lower = np.tril_indices(stop - start, k=-1)
+        diag_block[lower] = diag_block.T[lower]
+
+
+def _packed_n(size):
+    """
+    Number of rows of the square matrix whose packed upper triangle (see _pack_triu) has the given size
+    """
+    return int(round((np.sqrt(8 * size + 1) - 1) / 2))
+
+
+def _packed_index(n, rows, cols):
+    """
+    Position of each (row, column) entry (with row <= column) of an n by n matrix within its packed upper triangle
+    """
+    return rows * n - rows * (rows - 1) // 2 + (cols - rows)
+
+
+def _pack_triu(X):
+    """
+    Pack the upper triangle (including the diagonal) of a square matrix into a 1D array, one row at a time
+
+    Parameters
+    ----------
+    X : Numpy array or memmap
+        Square (symmetric) matrix
 
-    triu_inds = np.triu_indices(Z.shape[0], k=1)
+    Returns
+    ----------
+    packed : Numpy array
+        Array of length n * (n + 1) / 2 holding X[0, 0:n], X[1, 1:n], ..., X[n - 1, n - 1]
+    """
+    n = X.shape[0]
+    packed = np.empty(n * (n + 1) // 2, dtype=X.dtype)
+    start = 0
+    for i in range(n):
+        packed[start:start + n - i] = X[i, i:]
+        start += n - i
+    return packed
+
+
+def _unpack_triu(packed):
+    """
+    Inverse of _pack_triu: expand a packed upper triangle into the full symmetric matrix
+    """
+    n = _packed_n(packed.shape[0])
+    X = np.empty([n, n], dtype=packed.dtype)
+    start = 0
+    for i in range(n):
+        X[i, i:] = packed[start:start + n - i]
+        start += n - i
+    _symmetrize(X)
+    return X
+
+
+def _packed_take(packed, inds):
+    """
+    Index a packed upper triangle (see _pack_triu) by location, without expanding it
+
+    Parameters
+    ----------
+    packed : Numpy array
+        Packed upper triangle of an n by n symmetric matrix
+
+    inds : Numpy array
+        Indices of the locations to keep (in the order they should appear)
+
+    Returns
+    ----------
+    packed_sub : Numpy array
+        Packed upper triangle of the len(inds) by len(inds) matrix X[inds, :][:, inds]
+    """
+    n = _packed_n(packed.shape[0])
+    inds = np.asarray(inds)
+    k = len(inds)
+    packed_sub = np.empty(k * (k + 1) // 2, dtype=packed.dtype)
+    start = 0
+    for i in range(k):
+        rows = np.minimum(inds[i], inds[i:])
+        cols = np.maximum(inds[i], inds[i:])
+        packed_sub[start:start + k - i] = packed[_packed_index(n, rows, cols)]
+        start += k - i
+    return packed_sub
+
+
+def _open_memmap(dirname, prefix, dtype, shape):
+    """
+    Create a new (uniquely named, zero-filled) .npy file in the given directory and return a writeable memmap of it.
+    The file is deleted once the memmap (and every view of it) has been garbage collected (see _track_memmap).
+    """
+    if not os.path.isdir(dirname):
+        os.makedirs(dirname)
+    fd, fname = tempfile.mkstemp(prefix=prefix + '_', suffix='.npy', dir=dirname)
+    os.close(fd)
+    return _track_memmap(np.lib.format.open_memmap(fname, mode='w+', dtype=dtype, shape=shape))
+
+
+#weak references to the memmaps created by _open_memmap, keyed by the names of their backing files
+_memmap_refs = {}
+
+def _track_memmap(x):
+    """
+    Delete the backing file of a memmap once the memmap (and every view of it) has been garbage collected, so that
+    replaced (e.g. re-blurred or merged) memory-mapped models don't accumulate on disk.  Files are only deleted by the
+    process that created them.
+    """
+    fname = x.filename
+    pid = os.getpid()
+
+    def cleanup(ref):
+        if (_memmap_refs.get(fname) is ref) and (os.getpid() == pid):
+            del _memmap_refs[fname]
+            try:
+                os.remove(fname)
+            except OSError:
+                pass
+
+    _memmap_refs[fname] = weakref.ref(x, cleanup)
+    return x
+
+def _untrack_memmap(x):
+    """
+    Stop tracking a memmap created by _open_memmap (so that its backing file is kept when the memmap is garbage
+    collected) and return the name of the file.  Used to hand memory-mapped results over to another process, which
+    then tracks them with _attach_memmap.  Other arrays (including memmaps of files that _open_memmap didn't create,
+    e.g. cached expansions) are returned as is, so their files are never deleted.
+    """
+    fname = getattr(x, 'filename', None)
+    if (fname is None) or not (fname in _memmap_refs):
+        return x
+    _memmap_refs.pop(fname)
+    return fname
+
+def _attach_memmap(x):
+    """
+    Open (and track) a memory-mapped array that was handed over with _untrack_memmap.  Arrays are returned as is.
+    """
+    if isinstance(x, six.string_types):
+        return _track_memmap(np.load(x, mmap_mode='r+'))
+    return x
+
+def _empty_array(memmap_dir, prefix, dtype, shape):
+    """
+    New array of the given type and shape: a (tracked) memmap in memmap_dir, or an in-memory array if memmap_dir is
+    None
+    """
+    if memmap_dir is None:
+        return np.empty(shape, dtype=dtype)
+    return _open_memmap(memmap_dir, prefix, dtype, shape)
+
+
+def _triu_pairs(n, start, stop):
+    """
+    Row and column indices of a contiguous run of upper triangle (k=1) entries of an n by n matrix
+
+    Parameters
+    ----------
+    n : int
+        Number of rows (and columns) in the matrix
+
+    start : int
+        Position of the first pair, counting upper triangle entries in row-major order (as in np.triu_indices)
+
+    stop : int
+        Position one past the last pair
+
+    Returns
+    ----------
+    rows : Numpy array
+        Row index of each pair
+
+    cols : Numpy array
+        Column index of each pair
+    """
+    row_starts = np.cumsum(np.arange(n - 1, -1, -1)) - np.arange(n - 1, -1, -1)
+    pairs = np.arange(start, stop)
+    rows = np.searchsorted(row_starts, pairs, side='right') - 1
+    cols = pairs - row_starts[rows] + rows + 1
+    return rows, cols
+
+
+def _log_match_values(vals):
+    """
+    Split values into the logs of their positive and negative parts (the log-complex convention used by
+    _blur_corrmat).  Positive values go into the first output and everything else goes into the second output;
+    the unused part of each value is set to -inf.
+    """
+    with np.errstate(divide='ignore', invalid='ignore'):
+        pos = vals > 0
+        log_pos = np.where(pos, np.log(np.where(pos, vals, 1)), -np.inf)
+        log_neg = np.where(pos, -np.inf, np.log(np.abs(vals)))
+    return log_pos, log_neg
+
+
+def _match_index(weights):
+    """
+    Index the target locations that coincide with one (or more) of the source locations
+
+    Parameters
+    ----------
+    weights : Numpy array or scipy.sparse matrix
+        Log RBF weights (targets by sources) calculated using _log_rbf, or sparse (non-log) RBF weights calculated
+        using _sparse_rbf
+
+    Returns
+    ----------
+    match_src : Numpy array
+        For each target location, the index of its matching source location, -1 if it has no match, or -2 if it
+        matches several source locations
+
+    multi_matches : dict
+        Maps each target location with several matches to the indices of its matching source locations
+    """
+    if sparse.issparse(weights):
+        weights = weights.tocoo()
+        is_match = weights.data >= np.exp(-1e-8)
+        targets, sources = weights.row[is_match], weights.col[is_match]
+        order = np.lexsort((sources, targets))
+        targets, sources = targets[order], sources[order]
+    else:
+        targets, sources = np.nonzero(np.isclose(weights, 0))
+
+    match_src = -np.ones(weights.shape[0], dtype=np.int64)
+    counts = np.bincount(targets, minlength=weights.shape[0])
+    match_src[targets] = sources
+    match_src[counts > 1] = -2
+    multi_matches = {}
+    for t in np.where(counts > 1)[0]:
+        multi_matches[t] = sources[targets == t]
+    return match_src, multi_matches
+
+
+def _blur_setup(Z, weights, method='exact'):
+    """
+    Precompute the quantities shared by every block of a blur (see _blur_pairs)
+
+    Parameters
+    ----------
+    Z : Numpy array
+        Fisher z-transformed correlation matrix at the source locations
+
+    weights : Numpy array or scipy.sparse matrix
+        Log RBF weights (targets by sources) calculated using _log_rbf, or sparse (non-log) RBF weights calculated
+        using _sparse_rbf
+
+    method : 'exact', 'factorized' or 'sparse'
+        Blur method (see _blur_corrmat)
+
+    Returns
+    ----------
+    blur : dict
+        The inputs and the exact target-to-source location matches (see _match_index), the upper triangle indices of
+        Z and the logs of its positive and negative parts, and (for 'factorized' and 'sparse') the (max-shifted) matrix
+        factors.  The matrix products used by the 'factorized' and 'sparse' methods are added by _blur_products.
+    """
+    assert method in ('exact', 'factorized', 'sparse'), 'Unsupported blur method: ' + str(method)
+    assert (method == 'sparse') == sparse.issparse(weights), 'The sparse blur method requires sparse weights'
+
+    if method == 'sparse':
+        weights = weights.tocsr()
+    match_src, multi_matches = _match_index(weights)
+    blur = {'Z': Z, 'weights': weights, 'method': method, 'match_src': match_src, 'multi_matches': multi_matches}
+
+    #the factorized and sparse methods fall back on the exact sums for pairs that underflow (see _blur_pairs)
+    src_rows, src_cols = np.triu_indices(Z.shape[0], k=1)
 
     #need to do computations seperately for positive and negative values
-    sign_Z_full = np.sign(Z)
-    #logZ_pos_full = np.log(np.multiply(sign_Z_full > 0, Z))
-    #logZ_neg_full = np.log(np.multiply(sign_Z_full < 0, np.abs(Z)))
+    sign_Z = np.sign(Z[src_rows, src_cols])
+    with np.errstate(divide='ignore'):
+        blur['logZ_pos'] = np.log(np.multiply(sign_Z > 0, Z[src_rows, src_cols]))
+        blur['logZ_neg'] = np.log(np.multiply(sign_Z < 0, np.abs(Z[src_rows, src_cols])))
+    blur['src_rows'] = src_rows
+    blur['src_cols'] = src_cols
+
+    if method in ('factorized', 'sparse'):
+        #sum_{i<j} exp(w_xi + w_yj) * Z_ij = exp(a_x + a_y) * [E * triu(Z) * E^T]_xy, where E = exp(w - a) and a holds the
+        #largest (log) weight in each row (so every row of E has a maximum of 1).  sparse weights are already
+        #exponentiated, so their rows are divided by their largest weight instead.
+        if method == 'sparse':
+            with np.errstate(divide='ignore'):
+                shift = np.log(weights.max(axis=1).toarray().ravel())
+            shift[~np.isfinite(shift)] = 0
+            E = sparse.diags(np.exp(-shift)).dot(weights).tocsr()
+        else:
+            shift = np.max(weights, axis=1)
+            shift[~np.isfinite(shift)] = 0
+            E = np.exp(weights - shift[:, np.newaxis])
+        blur['shift'] = shift
+        blur['E'] = E
 
-    sign_Z = sign_Z_full[triu_inds]
-    logZ_pos = np.log(np.multiply(sign_Z > 0, Z[triu_inds]))
-    logZ_neg = np.log(np.multiply(sign_Z < 0, np.abs(Z[triu_inds])))
+        with np.errstate(invalid='ignore'):
+            U = {'pos': np.triu(np.where(Z > 0, Z, 0), k=1),
+                 'neg': np.triu(np.where(Z < 0, -Z, 0), k=1),
+                 'W': np.triu(np.ones_like(Z, dtype=np.float64), k=1)}
+        for key, u in U.items():
+            #scale each factor to a maximum of 1 (and keep track of the log of the scale)
+            scale = np.max(u) if u.size > 0 else 0
+            if not (np.isfinite(scale) and scale > 0):
+                scale = 1.
+            blur['U_' + key] = u / scale
+            blur['log_scale_' + key] = np.log(scale)
 
-    n = weights.shape[0]
-    K_pos = np.zeros([n, n])
-    K_neg = np.zeros([n, n])
-    W = np.zeros([n, n])
-
-    for x in range(n-1):
-        xweights = weights[x, :]
-        x_match = np.isclose(xweights, 0)
-        for y in range(x+1, n): #fill in upper triangle only
-            yweights = weights[y, :]
-            y_match = np.isclose(yweights, 0)
-
-            if np.any(x_match) and np.any(y_match): #the pair of locations we're filling in already exists in the given data
-                x_ind = np.where(x_match)[0]
-                y_ind = np.where(y_match)[0]
-                Z_match_val = np.mean(Z[x_ind, y_ind])
-                W[x, y] = 0.
-                if Z_match_val > 0:
-                    K_pos[x, y] = np.log(Z_match_val)
-                    K_neg[x, y] = -np.inf
-                else:
-                    K_pos[x, y] = -np.inf
-                    K_neg[x, y] = np.log(np.abs(Z_match_val))
-                continue
+    return blur
+
+
+def _blur_products(blur, targets):
+    """
+    Precompute the matrix products used to blur every location pair that involves at least one of the given target
+    locations ('factorized' and 'sparse' methods; see _blur_pairs).  Only the given targets' products are computed, so
+    blurring k new locations costs O(k x sources^2) rather than O(targets x sources^2).
+
+    Parameters
+    ----------
+    blur : dict
+        Precomputed blur quantities (see _blur_setup).  The products are added to blur.
+
+    targets : Numpy array
+        Indices of the target locations.  Every location pair that is blurred must involve at least one of them.
+    """
+    n = blur['E'].shape[0]
+    blur['target_col'] = -np.ones(n, dtype=np.int64)
+    blur['target_col'][targets] = np.arange(len(targets))
+    E_t = blur['E'][targets, :]
+    for key in ('pos', 'neg', 'W'):
+        u = blur['U_' + key]
+        #pairs (x, t) use T = U * E_t^T, and pairs (t, y) whose column location y isn't a target use Tt = U^T * E_t^T
+        blur['T_' + key] = E_t.dot(u.T).T
+        if len(targets) < n:
+            blur['Tt_' + key] = E_t.dot(u).T
 
-            next_weights = np.add.outer(xweights, yweights)
-            next_weights = next_weights[triu_inds]
 
-            W[x, y] = logsumexp(next_weights)
-            K_pos[x, y] = logsumexp(logZ_pos + next_weights)
-            K_neg[x, y] = logsumexp(logZ_neg + next_weights)
+def _blur_pairs(blur, rows, cols):
+    """
+    Blur a correlation matrix out to a set of (target) location pairs
+
+    Parameters
+    ----------
+    blur : dict
+        Precomputed blur quantities (see _blur_setup)
+
+    rows, cols : Numpy array
+        Target location pairs to fill in
+
+    Returns
+    ----------
+    K_pos, K_neg, W : Numpy arrays
+        Log positive numerator, log negative numerator, and log denominator for each target pair
+    """
+    K_pos = np.zeros(len(rows))
+    K_neg = np.zeros(len(rows))
+    W = np.zeros(len(rows))
+
+    #pairs of locations we're filling in that already exist in the given data.  locations with exactly one match are
+    #filled in with a single scatter; locations with several matches use the mean of the matched values.
+    match_src = blur['match_src']
+    matched = (match_src[rows] != -1) & (match_src[cols] != -1)
+    single = matched & (match_src[rows] >= 0) & (match_src[cols] >= 0)
+    K_pos[single], K_neg[single] = _log_match_values(blur['Z'][match_src[rows[single]], match_src[cols[single]]])
+    for i in np.where(matched & ~single)[0]:
+        x_ind = blur['multi_matches'].get(rows[i], match_src[rows[i]])
+        y_ind = blur['multi_matches'].get(cols[i], match_src[cols[i]])
+        K_pos[i], K_neg[i] = _log_match_values(np.mean(blur['Z'][x_ind, y_ind]))
+
+    blurred = np.where(~matched)[0]
+    if len(blurred) > 0 and blur['method'] in ('factorized', 'sparse'):
+        x = rows[blurred]
+        y = cols[blurred]
+        shift = blur['shift'][x] + blur['shift'][y]
+
+        #pairs are computed from the products of their column location if it's a target location (see _blur_products),
+        #and otherwise from the transposed products of their row location
+        target_col = blur['target_col']
+        by_col = target_col[y] >= 0
+        groups = [(sel, a, b, prefix) for sel, a, b, prefix in ((by_col, x, y, 'T_'), (~by_col, y, x, 'Tt_'))
+                  if np.any(sel)]
+        with np.errstate(divide='ignore'):
+            for key, out in (('pos', K_pos), ('neg', K_neg), ('W', W)):
+                G_pairs = np.zeros(len(blurred))
+                for sel, a, b, prefix in groups:
+                    #one matrix product for the block of rows and columns, and then pull out the needed pairs
+                    a_unique, a_local = np.unique(a[sel], return_inverse=True)
+                    b_unique, b_local = np.unique(b[sel], return_inverse=True)
+                    G = blur['E'][a_unique, :].dot(blur[prefix + key][:, target_col[b_unique]])
+                    G_pairs[sel] = G[a_local, b_local]
+                out[blurred] = np.log(G_pairs) + shift + blur['log_scale_' + key]
+
+        #every weight in a row can underflow after shifting when the row's largest weight belongs to a source
+        #location that is far from every other source location, so recompute any non-finite pairs exactly
+        #(K_pos or K_neg are legitimately -inf if Z has no positive or negative correlations, and every sum is
+        #legitimately -inf for sparse weights if either location has no source locations within the truncation radius)
+        finite = np.isfinite(W[blurred])
+        if blur['method'] == 'sparse':
+            has_weights = np.diff(blur['weights'].indptr) > 0
+            finite |= ~(has_weights[x] & has_weights[y])
+        for key, out in (('logZ_pos', K_pos), ('logZ_neg', K_neg)):
+            if np.any(np.isfinite(blur[key])):
+                finite &= np.isfinite(out[blurred])
+        underflow = blurred[~finite]
+        step = max(1, _BLUR_BUFFER_SIZE // max(len(blur['src_rows']), 1))
+        for start in range(0, len(underflow), step):
+            inds = underflow[start:(start + step)]
+            K_pos[inds], K_neg[inds], W[inds] = _blur_exact_pairs(blur, rows[inds], cols[inds])
+    elif len(blurred) > 0:
+        K_pos[blurred], K_neg[blurred], W[blurred] = _blur_exact_pairs(blur, rows[blurred], cols[blurred])
+
+    return K_pos, K_neg, W
+
+def _blur_exact_pairs(blur, rows, cols):
+    """
+    Blur a correlation matrix out to a set of (non-matching) target location pairs by summing over every pair of source
+    locations in log space (see _blur_pairs)
+    """
+    weights = blur['weights']
+    if sparse.issparse(weights):
+        #truncated (missing) sparse weights are zero, i.e. -inf in log space
+        with np.errstate(divide='ignore'):
+            next_weights = np.log(weights[rows, :].toarray())[:, blur['src_rows']] + \
+                           np.log(weights[cols, :].toarray())[:, blur['src_cols']]
+    else:
+        next_weights = weights[rows, :][:, blur['src_rows']] + weights[cols, :][:, blur['src_cols']]
+    return logsumexp(blur['logZ_pos'] + next_weights, axis=1), logsumexp(blur['logZ_neg'] + next_weights, axis=1), \
+           logsumexp(next_weights, axis=1)
+
+def _low_rank_corr(vecs_a, vals, vecs_b=None):
+    """
+    Correlations recovered from the leading eigenvectors and eigenvalues of a correlation matrix (see Model.reduce)
 
-    #turn K_neg into complex numbers.  Where K_neg is infinite, this results in nans for the real number parts, so we'll
-    #set any nans in K_neg.real to 0
-    #TODO: the next lines are redundant with code in _to_log_complex; consolidate
-    K_neg = np.multiply(0+1j, K_neg)
-    K_neg.real[np.isnan(K_neg)] = 0
-    K = K_pos + K_neg
+    Parameters
+    ----------
+    vecs_a : Numpy array
+        Rows of the eigenvectors for the first set of locations
+
+    vals : Numpy array
+        Eigenvalues
+
+    vecs_b : Numpy array or None
+        Rows of the eigenvectors for the second set of locations.  If None (default), the correlations between the
+        first set of locations are returned (with 1s on the diagonal).
+
+    Returns
+    ----------
+    K : Numpy array
+        len(vecs_a) by len(vecs_b) matrix of correlations
+    """
+    vecs_a = np.asarray(vecs_a, dtype=np.float64)
+    if vecs_b is None:
+        K = np.dot(vecs_a * vals, vecs_a.T)
+        np.fill_diagonal(K, 1)
+        return K
+    return np.dot(vecs_a * vals, np.asarray(vecs_b, dtype=np.float64).T)
 
-    return K + K.T, W + W.T
 
 def _to_log_complex(X):
     """
@@ -475,6 +1159,79 @@ def _to_exp_real(C):
         return posX
 
 
+def _simplify_log_complex(C, out=None, block_size=2 ** 18):
+    """
+    Cancel out the positive and negative parts of a log complex array, so that each entry has a finite real part OR a
+    finite imaginary part (or neither).  Equivalent to _to_log_complex(_to_exp_real(C)), but computed in log space, so
+    that nothing overflows or underflows (e.g. when the array is stored in single precision).
+
+    Parameters
+    ----------
+    C : Numpy array
+        Log complex array
+
+    out : Numpy array or None
+        Optional (1D) array to write the results into (e.g. a memmap, or C itself).  The results are then computed one
+        block of entries at a time.
+
+    block_size : int
+        Number of entries to simplify at a time when out is specified (default: 2 ** 18)
+
+    Returns
+    ----------
+    simplified : Numpy array
+        Log complex array (of the same type as C) representing the same values
+    """
+    if not (out is None):
+        for start in range(0, C.shape[0], block_size):
+            out[start:(start + block_size)] = _simplify_log_complex(C[start:(start + block_size)])
+        return out
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        #log(|exp(a) - exp(b)|) = max(a, b) + log(1 - exp(-|a - b|))
+        magnitude = np.maximum(C.real, C.imag) + np.log1p(-np.exp(-np.abs(C.real - C.imag)))
+    simplified = np.empty_like(C)
+    simplified.real = np.where(C.real > C.imag, magnitude, -np.inf)
+    simplified.imag = np.where(C.imag > C.real, magnitude, -np.inf)
+    return simplified
+
+
+def _logsumexp_stack(arrays, block_size=2 ** 18, out=None):
+    """
+    Elementwise log(sum(exp(x))) across a list of equally sized 1D arrays.  The arrays are stacked and reduced in a
+    single logsumexp call per block of entries, so at most len(arrays) x block_size values are copied at once.
+
+    Parameters
+    ----------
+    arrays : list of Numpy arrays
+        Logged arrays (all with the same shape)
+
+    block_size : int
+        Number of entries to reduce at a time (default: 2 ** 18)
+
+    out : Numpy array or None
+        Optional array to write the results into (e.g. a memmap).  If None (default), a new array is returned.
+
+    Returns
+    ----------
+    summed : Numpy array
+        log(exp(arrays[0]) + exp(arrays[1]) + ...), with the same type as the inputs (or out)
+    """
+    if out is None:
+        summed = np.empty(arrays[0].shape, dtype=np.result_type(*arrays))
+    else:
+        summed = out
+    if len(arrays) == 1:
+        summed[:] = arrays[0]
+        return summed
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        for start in range(0, summed.shape[0], block_size):
+            stop = min(start + block_size, summed.shape[0])
+            summed[start:stop] = logsumexp(np.vstack([x[start:stop] for x in arrays]), axis=0)
+    return summed
+
+
 def _logsubexp(x,y):
     """
     Subtracts logged arrays
@@ -507,7 +1264,8 @@ def _fill_upper_triangle(M, value):
     return upper_tri
 
 
-def _timeseries_recon(bo, mo, chunk_size=1000, preprocess='zscore', recon_loc_inds=None):
+def _timeseries_recon(bo, mo, chunk_size=1000, preprocess='zscore', recon_loc_inds=None, solver='pinv', ridge=0,
+                      rcond=1e-15):
     """
     Reconstruction done by chunking by session
         Parameters
@@ -521,14 +1279,45 @@ def _timeseries_recon(bo, mo, chunk_size=1000, preprocess='zscore', recon_loc_in
     chunk_size : int
         Size to break data into
 
-    recon_at_loc: list
-        Indexes for estimated location in average matrix (location in unknown_inds)
+    recon_loc_inds : list or None
+        If specified, only reconstruct these locations (indices into the model's unknown locations, in model order)
+
+    solver, ridge, rcond :
+        How to solve the known locations' system (see supereeg.ReconstructionOperator)
 
     Returns
     ----------
     results : ndarray
         Compiled reconstructed timeseries
     """
+    combined_data = None
+    for session, inds, block in _timeseries_recon_chunks(bo, mo, chunk_size=chunk_size, preprocess=preprocess,
+                                                         recon_loc_inds=recon_loc_inds, solver=solver, ridge=ridge,
+                                                         rcond=rcond):
+        if combined_data is None:
+            combined_data = np.zeros((bo.data.shape[0], block.shape[1]), dtype=block.dtype)
+        combined_data[inds, :] = block
+    return combined_data
+
+
+def _timeseries_recon_chunks(bo, mo, chunk_size=1000, preprocess='zscore', recon_loc_inds=None, solver='pinv', ridge=0,
+                             rcond=1e-15):
+    """
+    Reconstruct a brain object's timeseries one chunk at a time (see _timeseries_recon)
+
+    Each session's reconstructions are z-scored using statistics that are computed analytically, in a streaming pass
+    over the session's (known) data, so only one chunk of reconstructed data needs to be held in memory at a time.
+
+    Parameters
+    ----------
+    bo, mo, chunk_size, preprocess, recon_loc_inds, solver, ridge, rcond :
+        See _timeseries_recon
+
+    Returns
+    ----------
+    chunks : generator
+        Yields (session, sample indices, reconstructed data) tuples, in order.  Chunks never span sessions.
+    """
     if preprocess==None:
         data = bo.get_data().as_matrix()
     elif preprocess=='zscore':
@@ -545,17 +1334,24 @@ def _timeseries_recon(bo, mo, chunk_size=1000, preprocess='zscore', recon_loc_in
     brain_locs_in_model = _count_overlapping(mo.get_locs(), bo.get_locs())
     model_locs_in_brain = _count_overlapping(bo.get_locs(), mo.get_locs())
 
+    sessions = np.asarray(bo.sessions)
+    chunks = [(session, i[i >= 0]) for session in bo.sessions.unique()
+              for i in map(np.array, _chunker(np.where(sessions == session)[0].tolist(), chunk_size, fillvalue=-1))]
+
     if np.all(model_locs_in_brain):
         #if the model contains all of the locations (or fewer) than what are in the brain object, no reconstructions
         #are needed
-        return data[:, brain_locs_in_model]
+        for session, inds in chunks:
+            yield session, inds, data[inds, :][:, brain_locs_in_model]
+        return
 
     #otherwise, we'll need to do some work
-    Z = mo.get_model(z_transform=True)
+    from .reconstruction import ReconstructionOperator
     if ~np.any(brain_locs_in_model):
         #if none of the brain locations are in the model, we need to blur out the model to match up with the
         # locations in the brain object
         ### isnt this bypassed in the set_locs??
+        Z = mo.get_model(z_transform=True, copy=False)
         combined_locs = np.vstack((bo.get_locs(), mo.get_locs()))
         model_locs_in_brain = [False]*bo.get_locs().shape[0]
         model_locs_in_brain.extend([True]*mo.get_locs().shape[0])
@@ -563,40 +1359,50 @@ def _timeseries_recon(bo, mo, chunk_size=1000, preprocess='zscore', recon_loc_in
         rbf_weights = _log_rbf(combined_locs, mo.get_locs())
         Z = _blur_corrmat(Z, rbf_weights)
 
-    K = _z2r(Z)
-
-    known_inds, unknown_inds = known_unknown(mo.get_locs().as_matrix(), bo.get_locs().as_matrix(),
-                                                  bo.get_locs().as_matrix())
-    Kaa = K[known_inds, :][:, known_inds]
-    Kaa_inv = np.linalg.pinv(Kaa)
-
-    Kba = K[unknown_inds, :][:, known_inds]
-
-    sessions = bo.sessions.unique()
-    filter_chunks = []
-    chunks = [np.array(i) for session in sessions for i in _chunker(bo.sessions[bo.sessions == session].index.tolist(), chunk_size)]
-    for i in chunks:
-        filter_chunks.append([x for x in i if x is not None])
-    chunks=None
-
-
-    if recon_loc_inds:
-        combined_data = np.zeros((data.shape[0], len(recon_loc_inds)), dtype=data.dtype)
-
-        for x in filter_chunks:
-
-            combined_data[x,range(len(recon_loc_inds))] = _reconstruct_activity(data[x, :], Kba, Kaa_inv, recon_loc_inds=recon_loc_inds)
+        K = _z2r(Z)
 
+        known_inds, unknown_inds = known_unknown(mo.get_locs().as_matrix(), bo.get_locs().as_matrix(),
+                                                      bo.get_locs().as_matrix())
+        operator = ReconstructionOperator(K, known_inds, unknown_inds, solver=solver, ridge=ridge, rcond=rcond)
     else:
-        combined_data = np.zeros((data.shape[0], K.shape[0]), dtype=data.dtype)
-        combined_data[:, unknown_inds] = np.vstack(list(map(lambda x: _reconstruct_activity(data[x, :], Kba, Kaa_inv),
-                                                            filter_chunks)))
-        combined_data[:, known_inds] = data
-
-    for s in sessions:
-        combined_data[bo.sessions==s, :] = zscore(combined_data[bo.sessions==s, :])
+        #reuse the (cached) operator for this model and these electrodes, if there is one
+        operator = ReconstructionOperator.from_model(mo, bo.get_locs(), solver=solver, ridge=ridge, rcond=rcond)
+
+    #each output column is a linear combination of the known data: out = data * W.  recon_loc_inds index the unknown
+    #locations in the order they appear in the model.
+    if not (recon_loc_inds is None):
+        W = operator.weights[:, np.argsort(operator.unknown_inds)[np.ravel(recon_loc_inds)]]
+        n_out = W.shape[1]
+        known_cols, unknown_cols = [], np.arange(n_out)
+    else:
+        W = operator.weights
+        n_out = operator.n_locs
+        known_cols, unknown_cols = operator.known_inds, operator.unknown_inds
+
+    for session in bo.sessions.unique():
+        session_chunks = [inds for s, inds in chunks if s == session]
+
+        #streaming pass: mean and covariance of the known data, which give the mean and standard deviation of every
+        #output column
+        n = sum(len(inds) for inds in session_chunks)
+        mean = np.sum([np.sum(data[inds, :], axis=0) for inds in session_chunks], axis=0) / n
+        cov = np.zeros([data.shape[1], data.shape[1]])
+        for inds in session_chunks:
+            centered = data[inds, :] - mean
+            cov += np.dot(centered.T, centered)
+        cov /= n
+        known_std = np.sqrt(np.diag(cov))
+        unknown_std = np.sqrt(np.maximum(np.sum(W * np.dot(cov, W), axis=0), 0))
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            for inds in session_chunks:
+                centered = data[inds, :] - mean
+                block = np.zeros((len(inds), n_out), dtype=data.dtype)
+                block[:, unknown_cols] = np.divide(np.dot(centered, W), unknown_std)
+                if len(known_cols) > 0:
+                    block[:, known_cols] = np.divide(centered, known_std)
+                yield session, inds, block
 
-    return combined_data
 
 def _chunker(iterable, chunksize, fillvalue=None):
     """
@@ -625,32 +1431,6 @@ def _chunker(iterable, chunksize, fillvalue=None):
     return list(zip_longest(*args, fillvalue=fillvalue))
 
 
-def _reconstruct_activity(Y, Kba, Kaa_inv, recon_loc_inds=None):
-    """
-    Reconstruct activity
-
-    Parameters
-    ----------
-    Y : numpy array
-        brain object with zscored data
-
-    Kba : correlation matrix (unknown to known)
-
-    Kaa_inv : inverse correlation matrix (known to known)
-
-    zscore = False
-
-    Returns
-    ----------
-    results : ndarray
-        Reconstructed timeseries
-
-    """
-    if recon_loc_inds:
-        return np.squeeze(np.dot(np.dot(Kba, Kaa_inv), Y.T).T)[:, recon_loc_inds[0]]
-    else:
-        return np.dot(np.dot(Kba, Kaa_inv), Y.T).T
-
 def filter_elecs(bo, measure='kurtosis', threshold=10):
     """
     Filter electrodes based on kurtosis value
@@ -773,7 +1553,7 @@ def _fullfact(dims):
         return inds
 
 
-def model_compile(data):
+def model_compile(data, n_jobs=1):
     """
     Compile existing expanded correlation matrices.
 
@@ -782,17 +1562,412 @@ def model_compile(data):
     data : list of model object file directories
         Compiles model objects
 
+    n_jobs : int
+        Number of worker processes (default: 1).  If n_jobs is not 1, each
+        model is blurred out to the union of the models' locations in a
+        separate worker process, and the models are combined with a tree of
+        pairwise merges.  -1 uses every available core.
+
     Returns
     ----------
     model : Model object
         A new updated model object
 
     """
+    from .load import load, _load_field
+    from .model import Model
+
+    if n_jobs == 1:
+        m = load(data[0])
+        m.update(data[1:])
+        return m
+
+    locs, tmp = _unique(np.vstack([np.asarray(_load_field(x, 'locs')) for x in data]))
+    n_subs = sum(_load_field(x, 'n_subs') for x in data)
+    return Model(data=list(data), locs=locs, n_subs=n_subs, n_jobs=n_jobs)
+
+
+def model_build(data, locs=None, template=None, checkpoint=None, checkpoint_every=10, prefetch=2, cache_dir=None,
+                kurtosis_threshold=None, **kwargs):
+    """
+    Build a model from many brain object files, one subject at a time.
+
+    Each brain object is read from disk, blurred out to the model's locations
+    and folded into a running (log) numerator and denominator, so only one
+    subject is held in memory at a time.  The next files are read in a
+    background thread while the current subject is being processed.  If a
+    checkpoint file is specified, the partial model (and the list of files
+    that have been processed) is saved periodically, and an interrupted build
+    resumes from the last checkpoint when model_build is called again.
+
+    If a cache directory is specified, each subject's blurred contribution to
+    the model is also saved there (keyed by the contents of the brain object
+    file and the model settings), so that later builds from any subset of the
+    same files (at the same locations) reuse the cached contributions rather
+    than recomputing them.
+
+    Parameters
+    ----------
+    data : str or list of str
+        A directory (every .bo file in the directory is used), a manifest file
+        (a text file listing one .bo file per line; relative paths are
+        relative to the manifest's directory), or a list of .bo files
+
+    locs : pandas.DataFrame or np.ndarray
+        Model locations.  If neither locs nor template is specified, the
+        union of every brain object's locations is used.
+
+    template : str or supereeg.Nifti
+        Template used to set the model locations (instead of locs)
+
+    checkpoint : str or None
+        Checkpoint file.  If the file exists, the build resumes from it;
+        otherwise it is created.  If None (default), no checkpoints are saved.
+
+    checkpoint_every : int
+        Number of subjects processed between checkpoints (default: 10).  A
+        final checkpoint is always saved once every subject has been processed.
+
+    prefetch : int
+        Number of brain objects read ahead of the one being processed
+        (default: 2).  0 reads each file just before it is processed.
+
+    cache_dir : str or None
+        Directory of cached subject contributions.  If None (default),
+        contributions are not cached.  Cached files are never deleted
+        automatically.
+
+    kurtosis_threshold : positive scalar or None
+        If specified, overrides the kurtosis threshold saved with each brain
+        object (electrodes whose kurtosis exceeds the threshold are excluded).
+
+    kwargs : dict
+        Other keyword arguments (e.g. rbf_width, blur_method, precision) are
+        passed to each subject's Model
+
+    Returns
+    ----------
+    model : supereeg.Model
+        Model built from every brain object
+
+    """
+    from .brain import Brain
+    from .nifti import Nifti
     from .load import load
+    from .model import Model, _merge_contributions
+
+    fnames = _brain_files(data)
+    assert len(fnames) > 0, 'no brain objects to build a model from'
+
+    state = None
+    if not (checkpoint is None) and os.path.exists(checkpoint):
+        state = _load_checkpoint(checkpoint)
+        for key, value in [('rbf_width', kwargs.get('rbf_width')), ('precision', kwargs.get('precision')),
+                           ('kurtosis_threshold', kurtosis_threshold)]:
+            if not (value is None) and (value != state.get(key)):
+                raise ValueError('Checkpoint ' + checkpoint + ' was created with ' + key + '=' +
+                                 str(state.get(key)))
+        if not (locs is None):
+            new_locs, tmp = _unique(np.asarray(locs))
+            if not ((new_locs.shape == state['locs'].shape) and np.allclose(new_locs, state['locs'])):
+                raise ValueError('Checkpoint ' + checkpoint + ' was created with different locations')
+        locs = state['locs']
+    elif not (template is None):
+        if isinstance(template, six.string_types):
+            template = load(template)
+        assert type(template) == Nifti, 'template must be a Nifti object or a path to a Nifti object'
+        locs = Brain(template).get_locs().as_matrix()
+    elif locs is None:
+        locs = np.vstack([np.asarray(_load_field_locked(x, 'locs')) for x in fnames])
+    locs, tmp = _unique(np.asarray(locs))
+
+    if state is None:
+        state = {'numerator': None, 'denominator': None, 'locs': locs, 'n_subs': 0, 'processed': [],
+                 'meta': kwargs.pop('meta', None), 'rbf_width': kwargs.get('rbf_width', 20),
+                 'precision': kwargs.get('precision', 'float64'), 'kurtosis_threshold': kurtosis_threshold}
+    else:
+        kwargs.pop('meta', None)
+    kwargs['rbf_width'] = state['rbf_width']
+    kwargs['precision'] = state['precision']
+    kurtosis_threshold = state.get('kurtosis_threshold')
+
+    processed = set(state['processed'])
+    remaining = [x for x in fnames if not (x in processed)]
+
+    #only read the brain objects whose contributions haven't been cached.  cached contributions are loaded (memory
+    #mapped) one at a time, as they're merged.
+    keys = {}
+    cached = set()
+    if not (cache_dir is None):
+        for fname in remaining:
+            keys[fname] = _contribution_key(fname, locs, kurtosis_threshold, kwargs)
+            if _has_npy_pair(cache_dir, keys[fname]):
+                cached.add(fname)
+    brains = _prefetch([x for x in remaining if not (x in cached)], prefetch)
+
+    since_checkpoint = 0
+    for fname in remaining:
+        if fname in cached:
+            contribution = _load_npy_pair(cache_dir, keys[fname], mmap_mode='r')
+        else:
+            bo_fname, bo = next(brains)
+            assert bo_fname == fname
+            if not (kurtosis_threshold is None):
+                bo.kurtosis_threshold = kurtosis_threshold
+            mo = Model(data=bo, locs=locs, **kwargs)
+            contribution = (mo._numerator, mo._denominator)
+            if not (cache_dir is None):
+                _save_npy_pair(cache_dir, keys[fname], contribution)
+
+            if state['meta'] is None:
+                state['meta'] = mo.meta
+            elif (type(state['meta']) == dict) and (type(mo.meta) == dict):
+                state['meta'].update(mo.meta)
+
+        if state['numerator'] is None:
+            state['numerator'], state['denominator'] = (np.array(x) for x in contribution)
+        else:
+            state['numerator'], state['denominator'] = _merge_contributions((state['numerator'], state['denominator']),
+                                                                            contribution,
+                                                                            memmap_dir=kwargs.get('memmap_dir', None))
+        state['n_subs'] += 1
+        state['processed'].append(fname)
+
+        since_checkpoint += 1
+        if not (checkpoint is None) and (since_checkpoint >= checkpoint_every):
+            _save_checkpoint(checkpoint, state)
+            since_checkpoint = 0
+
+    brains.close()
+
+    if not (checkpoint is None) and (since_checkpoint > 0):
+        _save_checkpoint(checkpoint, state)
+
+    return Model(numerator=_simplify_log_complex(state['numerator']), denominator=state['denominator'], locs=locs,
+                 n_subs=state['n_subs'], meta=state['meta'], **kwargs)
+
 
-    m = load(data[0])
-    m.update(data[1:])
-    return m
+#deepdish/pytables aren't thread safe, so every hdf5 file read or written by model_build goes through this lock
+_hdf5_lock = threading.Lock()
+
+def _load_field_locked(fname, field):
+    """Loads a particular field of a file (holding _hdf5_lock)"""
+    from .load import _load_field
+
+    with _hdf5_lock:
+        return _load_field(fname, field)
+
+def _brain_files(data):
+    """Absolute paths of the brain object files in a directory or manifest file (or a list of files)"""
+    if not isinstance(data, six.string_types):
+        return [os.path.abspath(x) for x in data]
+    if os.path.isdir(data):
+        return sorted(glob.glob(os.path.join(os.path.abspath(data), '*.bo')))
+
+    root = os.path.dirname(os.path.abspath(data))
+    with open(data) as f:
+        lines = [line.strip() for line in f]
+    return [os.path.join(root, x) for x in lines if (len(x) > 0) and not x.startswith('#')]
+
+def _prefetch(fnames, n):
+    """
+    Generator of (fname, brain object) tuples.  Files are loaded in a background thread, up to n files ahead of the
+    caller, so that reading the next files overlaps with processing the current one.
+    """
+    from .load import load
+
+    if n < 1:
+        for fname in fnames:
+            with _hdf5_lock:
+                bo = load(fname)
+            yield fname, bo
+        return
+
+    loaded = queue.Queue(maxsize=n)
+    stop = threading.Event()
+
+    def reader():
+        for fname in fnames:
+            try:
+                with _hdf5_lock:
+                    item = (fname, load(fname), None)
+            except Exception as e:
+                item = (fname, None, e)
+            while not stop.is_set():
+                try:
+                    loaded.put(item, timeout=0.1)
+                    break
+                except queue.Full:
+                    pass
+            if stop.is_set() or not (item[2] is None):
+                return
+
+    thread = threading.Thread(target=reader)
+    thread.daemon = True
+    thread.start()
+    try:
+        for i in range(len(fnames)):
+            fname, bo, error = loaded.get()
+            if not (error is None):
+                raise error
+            yield fname, bo
+    finally:
+        stop.set()
+        thread.join()
+
+def _save_checkpoint(fname, state):
+    """Save a partially built model (see model_build).  The checkpoint is written under a temporary name and then
+    renamed, so an interrupted save never corrupts the previous checkpoint."""
+    directory = os.path.dirname(os.path.abspath(fname))
+    fd, tmp = tempfile.mkstemp(suffix='.h5', dir=directory)
+    os.close(fd)
+    with _hdf5_lock:
+        dd.io.save(tmp, {'numerator': state['numerator'], 'denominator': state['denominator'],
+                         'locs': state['locs'], 'n_subs': state['n_subs'], 'meta': state['meta'],
+                         'processed': '\n'.join(state['processed']), 'rbf_width': state['rbf_width'],
+                         'precision': state['precision'], 'kurtosis_threshold': state.get('kurtosis_threshold')},
+                    compression='blosc')
+    os.rename(tmp, fname)
+
+def _contribution_key(fname, locs, kurtosis_threshold, kwargs):
+    """
+    Cache key of a subject's contribution to a model: a hash of the brain object file's contents, the model
+    locations and every setting that affects the blurred numerator and denominator
+    """
+    data_hash = hashlib.sha1()
+    with open(fname, 'rb') as f:
+        for block in iter(lambda: f.read(2 ** 20), b''):
+            data_hash.update(block)
+    if kurtosis_threshold is None:
+        try:
+            kurtosis_threshold = _load_field_locked(fname, 'kurtosis_threshold')
+        except (KeyError, ValueError):
+            pass
+    locs_hash = hashlib.sha1(np.ascontiguousarray(locs, dtype=np.float64)).hexdigest()
+    key = (data_hash.hexdigest(), locs_hash, float(kwargs['rbf_width']),
+           None if kurtosis_threshold is None else float(kurtosis_threshold), kwargs.get('blur_method', 'exact'),
+           kwargs.get('rbf_tol', None), kwargs['precision'])
+    return hashlib.sha1(repr(key).encode('utf-8')).hexdigest()
+
+def _npy_pair_fnames(directory, name):
+    """Names of the numerator and denominator .npy files saved under the given name (see _save_npy_pair)"""
+    return [os.path.join(directory, name + '_' + x + '.npy') for x in ('numerator', 'denominator')]
+
+def _has_npy_pair(directory, name):
+    """Whether a (numerator, denominator) pair has been saved under the given name (see _save_npy_pair)"""
+    return all(os.path.exists(fname) for fname in _npy_pair_fnames(directory, name))
+
+def _load_npy_pair(directory, name, mmap_mode=None):
+    """Load a (numerator, denominator) pair saved by _save_npy_pair (or return None if it hasn't been saved)"""
+    if not _has_npy_pair(directory, name):
+        return None
+    return tuple(np.load(fname, mmap_mode=mmap_mode) for fname in _npy_pair_fnames(directory, name))
+
+def _save_npy_pair(directory, name, pair):
+    """Save a (numerator, denominator) pair to .npy files in a directory (each file is written under a temporary name
+    and then renamed, so other processes never see partially written files)"""
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    for fname, x in zip(_npy_pair_fnames(directory, name), pair):
+        fd, tmp = tempfile.mkstemp(suffix='.npy', dir=directory)
+        with os.fdopen(fd, 'wb') as f:
+            np.save(f, x)
+        os.rename(tmp, fname)
+
+def _load_checkpoint(fname):
+    """Load a partially built model saved by _save_checkpoint"""
+    with _hdf5_lock:
+        state = dd.io.load(fname)
+    state['processed'] = [x for x in state['processed'].split('\n') if len(x) > 0]
+    return state
+
+
+def model_leave_one_out(data, locs=None, template=None, n_jobs=1, **kwargs):
+    """
+    Generate leave-one-subject-out models.
+
+    Each subject's contribution to the model is computed once, and the i^th
+    model (built from every subject except subject i) is assembled by merging
+    the contributions of the subjects before and after subject i in log space
+    (using running prefix sums and precomputed suffix sums).  Unlike
+    subtracting a subject's model from the full model (see Model.__sub__),
+    the resulting models are exact and stable.  Contributions (and suffix
+    sums) are held in memory until they are no longer needed.
+
+    Parameters
+    ----------
+    data : list of supereeg.Brain, supereeg.Nifti, supereeg.Model (or paths to these objects)
+        Subjects' data (at least two subjects)
+
+    locs : pandas.DataFrame or np.ndarray
+        Model locations.  If neither locs nor template is specified, the
+        union of every subject's locations is used.
+
+    template : str or supereeg.Nifti
+        Template used to set the model locations (instead of locs)
+
+    n_jobs : int
+        Number of worker processes used to compute the subjects' contributions
+        (default: 1).  -1 uses every available core.
+
+    kwargs : dict
+        Other keyword arguments (e.g. rbf_width, blur_method, precision, meta)
+        are passed to each Model
+
+    Returns
+    ----------
+    models : generator of supereeg.Model
+        The i^th model is built from every subject except data[i].  Models are
+        computed as they are requested.
+
+    """
+    from .brain import Brain
+    from .nifti import Nifti
+    from .load import load
+    from .model import Model, _data_locs, _subject_contribution, _merge_contributions
+
+    n = len(data)
+    assert n > 1, 'at least two subjects are needed to leave one out'
+
+    if not (template is None):
+        if isinstance(template, six.string_types):
+            template = load(template)
+        assert type(template) == Nifti, 'template must be a Nifti object or a path to a Nifti object'
+        locs = Brain(template).get_locs().as_matrix()
+    elif locs is None:
+        locs = np.vstack([_data_locs(x) for x in data])
+    locs, tmp = _unique(np.asarray(locs))
+
+    meta = kwargs.pop('meta', None)
+    contributions = [(_attach_memmap(x[0]), _attach_memmap(x[1])) for x in Parallel(n_jobs=n_jobs)(
+        delayed(_subject_contribution)(x, locs, None, kwargs, detach=True) for x in data)]
+
+    memmap_dir = kwargs.get('memmap_dir', None)
+
+    #suffixes[i] is the merged contribution of subjects i, i + 1, ..., n - 1
+    suffixes = [None] * (n + 1)
+    suffixes[n - 1] = contributions[n - 1]
+    for i in range(n - 2, 0, -1):
+        suffixes[i] = _merge_contributions(contributions[i], suffixes[i + 1], memmap_dir=memmap_dir)
+
+    prefix = None
+    for i in range(n):
+        if prefix is None:
+            numerator, denominator = suffixes[i + 1]
+        elif suffixes[i + 1] is None:
+            numerator, denominator = prefix
+        else:
+            numerator, denominator = _merge_contributions(prefix, suffixes[i + 1], memmap_dir=memmap_dir)
+        suffixes[i + 1] = None
+
+        yield Model(numerator=_simplify_log_complex(numerator), denominator=np.copy(denominator), locs=locs,
+                    n_subs=n - 1, meta=copy.deepcopy(meta), n_jobs=n_jobs, **kwargs)
+
+        if prefix is None:
+            prefix = contributions[i]
+        else:
+            prefix = _merge_contributions(prefix, contributions[i], memmap_dir=memmap_dir)
+        contributions[i] = None
 
 
 def _near_neighbor(bo, mo, match_threshold='auto'): #TODO: should this be part of bo.get_locs() or Brain.__init__, or possibly model.__init__?
@@ -1076,6 +2251,28 @@ def remove_electrode(subkarray, subarray, electrode):
     other_inds = [i for i in range(np.shape(subkarray)[0]) if i != electrode]
     return np.delete(subkarray, rm_ind, 0), other_inds
 
+def _loc_index(X, Y):
+    """
+    Finds the row of X that matches each row of Y, using a hash index of X's rows
+
+    Parameters
+    ----------
+    X : Numpy array or pandas DataFrame of reference locations
+
+    Y : Numpy array or pandas DataFrame of to-be-tested locations
+
+    Returns
+    ----------
+    results : ndarray
+        Array of length Y.shape[0] with the index of the (first) matching row of X for each row of Y, or -1 for rows
+        of Y that aren't in X
+    """
+    index = {}
+    for i, x in enumerate(map(tuple, np.asarray(X))):
+        index.setdefault(x, i)
+    return np.array([index.get(tuple(y), -1) for y in np.asarray(Y)], dtype=np.int64)
+
+
 def _count_overlapping(X, Y):
     """
     Finds overlapping rows in two matrices
@@ -1095,6 +2292,24 @@ def _count_overlapping(X, Y):
     return np.sum([(Y == x).all(1) for idx, x in X.iterrows()], 0).astype(bool)
 
 
+def _loc_labels(observed):
+    """
+    Labels each location as observed or reconstructed
+
+    Parameters
+    ----------
+    observed : ndarray
+        Boolean array with one entry per location; True denotes locations that were observed
+
+    Returns
+    ----------
+    results : list
+        'observed' or 'reconstructed', for each location
+    """
+
+    return ['observed' if x else 'reconstructed' for x in np.ravel(observed)]
+
+
 def make_gif_pngs(nifti, gif_path, index=range(100, 200), name=None, **kwargs):
     """
     Plots series of nifti timepoints as nilearn plot_glass_brain in .png format
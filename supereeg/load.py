@@ -9,7 +9,7 @@ from .brain import Brain
 from .model import Model
 from .nifti import Nifti
 from .location import Location
-from .helpers import _resample_nii
+from .helpers import _resample_nii, _unpack_triu
 
 BASE_URL = 'https://docs.google.com/uc?export=download'
 homedir = os.path.expanduser('~')
@@ -27,7 +27,7 @@ datadict = { #TODO: do the data types need to be specified or could they be infe
 }
 
 def load(fname, vox_size=None, return_type=None, sample_inds=None,
-         loc_inds=None, field=None):
+         loc_inds=None, field=None, precision=None, lazy=False):
     """
     Load nifti file, brain or model object, or example data.
 
@@ -90,7 +90,21 @@ def load(fname, vox_size=None, return_type=None, sample_inds=None,
 
     field : str
         The particular field of the data you want to load. This will work for
-        Brain objects and Model objects.
+        Brain objects and Model objects.  Model numerators and denominators are
+        stored in .mo files as packed upper triangles (the matrices are
+        symmetric); loading either field returns the full locations x
+        locations matrix, as for files saved by earlier versions.
+
+    precision : 'float64', 'float32' or None
+        Floating point precision used to store the numerator and denominator of
+        a loaded Model object.  If None (default), the precision recorded in
+        the .mo file is used.
+
+    lazy : bool
+        If True, a Brain object's data are only read from disk when they're
+        first accessed, and slices (see Brain.get_slice) only read the
+        requested samples.  Only works for Brain objects loaded from a path.
+        (Default: False)
 
     Returns
     ----------
@@ -101,12 +115,24 @@ def load(fname, vox_size=None, return_type=None, sample_inds=None,
     if field != None and (sample_inds!=None or loc_inds!=None):
         raise ValueError("Using both field and slicing currently not supported.")
 
+    if lazy and (fname in datadict.keys() or fname.split('.')[-1] != 'bo'):
+        raise ValueError("Can only lazily load Brain objects from a path.")
+
     if fname in datadict.keys():
         data = _load_example(fname, datadict[fname], sample_inds, loc_inds, field)
     else:
-        data = _load_from_path(fname, sample_inds, loc_inds, field)
+        data = _load_from_path(fname, sample_inds, loc_inds, field, lazy=lazy)
+    if field in ('numerator', 'denominator') and (np.ndim(data) == 1):
+        data = _unpack_triu(data)
     if field is None:
-        return _convert(data, return_type, vox_size)
+        data = _convert(data, return_type, vox_size)
+        if not (precision is None):
+            if not isinstance(data, Model):
+                raise ValueError("Can only set the precision of Model objects.")
+            assert precision in ('float64', 'float32'), 'Unsupported precision: ' + str(precision)
+            data.precision = precision
+            data._cast()
+        return data
     else:
         return data
 
@@ -184,7 +210,7 @@ def _download(fname, data, ext):
     with open(fullpath + '.' + ext, 'wb') as f:
         f.write(data.content)
 
-def _load_from_path(fpath, sample_inds=None, loc_inds=None, field=None):
+def _load_from_path(fpath, sample_inds=None, loc_inds=None, field=None, lazy=False):
     """ Load a file from a local path """
     try:
         ext = fpath.split('.')[-1]
@@ -198,6 +224,8 @@ def _load_from_path(fpath, sample_inds=None, loc_inds=None, field=None):
     elif ext=='bo':
         if sample_inds!=None or loc_inds!=None:
             return Brain(**_load_slice(fpath, sample_inds, loc_inds))
+        elif lazy:
+            return _load_lazy(fpath)
         else:
             return Brain(**dd.io.load(fpath))
     elif ext=='mo':
@@ -241,6 +269,38 @@ def _load_field(fname, field):
     """ Loads a particular field of a file """
     return dd.io.load(fname, group='/' + field) #FIXME: use os.path.join rather than using slashes
 
+def _load_lazy(fname):
+    """
+    Load a brain object whose data are read from disk when they're first accessed
+
+    Parameters
+    ----------
+    fname : str
+        Path to brain object
+
+    Returns
+    ----------
+    bo : supereeg.Brain
+        Brain object backed by the file
+    """
+    fields = {}
+    for key in ['locs', 'sessions', 'sample_rate', 'kurtosis', 'kurtosis_threshold', 'meta', 'date_created',
+                'minimum_voxel_size', 'maximum_voxel_size', 'label', 'filter']:
+        try:
+            fields[key] = _load_field(fname, key)
+        except (KeyError, ValueError):
+            pass
+
+    if not ('kurtosis' in fields):
+        #kurtosis values can only be computed from the data
+        return Brain(**dd.io.load(fname))
+
+    #the data are replaced by the (lazily loaded) file contents
+    bo = Brain(data=np.zeros((0, np.shape(fields['locs'])[0])), **fields)
+    bo.data = None
+    bo._data_file = fname
+    return bo
+
 def _load_slice(fname, sample_inds=None, loc_inds=None):
     """
     Load a slice of a brain object
@@ -1,7 +1,10 @@
 from __future__ import division
 from __future__ import print_function
+import os
 import time
+import hashlib
 import copy
+import uuid
 import warnings
 import six
 import pandas as pd
@@ -9,11 +12,18 @@ import numpy as np
 import seaborn as sns
 import deepdish as dd
 import matplotlib.pyplot as plt
-from .helpers import _get_corrmat, _r2z, _z2r, _log_rbf, _blur_corrmat, _plot_borderless,\
-    _near_neighbor, _timeseries_recon, _count_overlapping, _plot_locs_connectome, \
+from scipy.stats import zscore
+from scipy.linalg import eigh
+from joblib import Parallel, delayed, cpu_count
+from .helpers import _get_corrmat, _r2z, _z2r, _log_rbf, _sparse_rbf, _blur_corrmat, _plot_borderless,\
+    _near_neighbor, _corr_column, _timeseries_recon, _timeseries_recon_chunks, _count_overlapping, _loc_labels, \
+    _loc_index, _plot_locs_connectome, \
     _plot_locs_hyp, _gray, _nifti_to_brain,\
-    _unique, _union, _empty, _to_log_complex, _to_exp_real
-from .brain import Brain
+    _unique, _union, _empty, _to_log_complex, _simplify_log_complex, _pack_triu, _unpack_triu, _packed_n, \
+    _packed_take, _low_rank_corr, _logsumexp_stack, _empty_array, _untrack_memmap, _attach_memmap, \
+    _load_npy_pair, _save_npy_pair
+from .brain import Brain, _save_chunks
+from .cache import LRUCache
 from .nifti import Nifti
 
 
@@ -39,7 +49,8 @@ class Model(object):
         Path to a template nifti file used to set model locations
     numerator : Numpy.ndarray
         (Optional) A locations x locations matrix comprising the sum of the log z-transformed
-        correlation matrices over subjects.  If used, must also pass denominator,
+        correlation matrices over subjects (or its packed upper triangle, as stored in
+        .mo files).  If used, must also pass denominator,
         locs and n_subs. Otherwise, numerator will be computed from the brain
         object data.
     denominator : Numpy.ndarray
@@ -53,6 +64,39 @@ class Model(object):
     rbf_width : positive scalar
         The width of the radial basis function (RBF) used as a spatial prior for
         smoothing estimates at nearby locations.  (Default: 20)
+    blur_method : 'exact' or 'factorized'
+        How the model is blurred out to new locations.  'exact' (default) sums
+        over every pair of known locations in log space; 'factorized' computes
+        the same sums using (much faster) matrix products, and is recommended for
+        models with many locations (e.g. fine-grained templates).
+    rbf_tol : positive scalar or None
+        If specified, RBF weights smaller than rbf_tol are treated as 0 when
+        blurring the model (so only nearby locations contribute to each
+        estimate), which makes blurring to large templates much faster.  If None
+        (default), every location contributes.
+    n_jobs : int
+        Number of worker processes used to blur the model out to new locations
+        (default: 1).  -1 uses every available core.  When a list of objects
+        is passed, each worker builds whole subjects' models instead (which
+        are then combined with a tree of pairwise merges).
+    memmap_dir : str or None
+        If specified, blurred numerators and denominators are computed one block
+        at a time and stored in memory-mapped .npy files in this directory (which
+        then back the model), so that models with many locations (e.g. voxel
+        templates) don't need to fit in memory.  Files are deleted once no model
+        uses them anymore.  If None (default), models are stored in memory.
+    precision : 'float64' or 'float32'
+        Floating point precision used to store the (log) numerator and
+        denominator.  'float32' halves the memory (and disk space) needed for
+        the model; recovered correlation matrices are still computed in double
+        precision.  (Default: 'float64')
+    eigenvectors : Numpy.ndarray
+        (Optional) A locations x rank matrix of the leading eigenvectors of the
+        model's correlation matrix, for reduced (low rank) models (see reduce).
+        If used, must also pass eigenvalues and locs (and not numerator or
+        denominator).
+    eigenvalues : Numpy.ndarray
+        (Optional) The corresponding eigenvalues
     meta : dict
         Dict containing whatever you want:
         Initialized with a stability field {'stable':True}. This is changed
@@ -66,12 +110,22 @@ class Model(object):
     ----------
     numerator : Numpy.ndarray
         A locations x locations matrix comprising the sum of the log z-transformed
-        correlation matrices over subjects
+        correlation matrices over subjects.  The model only stores the upper
+        triangle (the matrix is symmetric), and expands it when this attribute
+        is accessed.  The expanded matrix is read-only (changing it in place
+        would not change the model); assign a new matrix to change the model.
     denominator : Numpy.ndarray
         A locations x locations matrix comprising the log sum of the (weighted) number of
-        subjects contributing to each matrix cell
+        subjects contributing to each matrix cell (stored as a packed upper triangle,
+        and read-only, like the numerator)
     n_subs : int
         Number of subject used to create the model
+    eigenvectors : Numpy.ndarray or None
+        For reduced models (see reduce), a locations x rank matrix of the
+        leading eigenvectors of the model's correlation matrix (reduced models
+        don't store a numerator or denominator).  None for full models.
+    eigenvalues : Numpy.ndarray or None
+        For reduced models, the corresponding eigenvalues
 
     Returns
     ----------
@@ -80,12 +134,15 @@ class Model(object):
     """
     def __init__(self, data=None, locs=None, template=None,
                  numerator=None, denominator=None,
-                 n_subs=None, meta=None, date_created=None, rbf_width=20, save=None):
+                 n_subs=None, meta=None, date_created=None, rbf_width=20, blur_method='exact', rbf_tol=None,
+                 n_jobs=1, memmap_dir=None, precision='float64', eigenvectors=None, eigenvalues=None, save=None):
         from .load import load
 
         self.locs = None
         self.numerator = None
         self.denominator = None
+        self.eigenvectors = None
+        self.eigenvalues = None
         self.n_subs = 0
         self.meta = meta
         if self.meta is None:
@@ -93,6 +150,12 @@ class Model(object):
         self.date_created = date_created
         #self.rbf_width = float(rbf_width)
         self.rbf_width = rbf_width
+        self.blur_method = blur_method
+        self.rbf_tol = rbf_tol
+        self.n_jobs = n_jobs
+        self.memmap_dir = memmap_dir
+        assert precision in ('float64', 'float32'), 'Unsupported precision: ' + str(precision)
+        self.precision = precision
 
         if n_subs is None:
             n_subs = 1
@@ -117,12 +180,35 @@ class Model(object):
                                 all_locs = np.vstack((all_locs, data[i].get_locs().as_matrix()))
                     locs, loc_inds = _unique(all_locs)
 
-                    self.__init__(data=data[0], locs=locs, template=template, meta=self.meta, rbf_width=self.rbf_width,
-                                  n_subs=1)
-
-                    for i in range(1, len(data)):
-                        self.update(Model(data=data[i], locs=locs, template=template, meta=self.meta,
-                                          rbf_width=self.rbf_width, n_subs=1))
+                    if (self.n_jobs == 1) or (len(data) == 1):
+                        self.__init__(data=data[0], locs=locs, template=template, meta=self.meta,
+                                      rbf_width=self.rbf_width, blur_method=self.blur_method, rbf_tol=self.rbf_tol,
+                                      n_jobs=self.n_jobs, memmap_dir=self.memmap_dir, precision=self.precision,
+                                      n_subs=1)
+
+                        for i in range(1, len(data)):
+                            self.update(Model(data=data[i], locs=locs, template=template, meta=self.meta,
+                                              rbf_width=self.rbf_width, blur_method=self.blur_method,
+                                              rbf_tol=self.rbf_tol, n_jobs=self.n_jobs, memmap_dir=self.memmap_dir,
+                                              precision=self.precision, n_subs=1))
+                    else:
+                        #build each subject's model in a separate worker process (all at the same locations), and
+                        #combine them with a tree of pairwise log-sum-exp merges
+                        if (locs is None) and (template is None):
+                            locs, loc_inds = _unique(np.vstack([_data_locs(x) for x in data]))
+                        #(the merged numerator and denominator get their own names, so that they aren't combined
+                        #with the model again below)
+                        merged_num, merged_den, locs, meta = _build_parallel(data, locs, template, self.n_jobs,
+                                                                             dict(meta=self.meta,
+                                                                                  rbf_width=self.rbf_width,
+                                                                                  blur_method=self.blur_method,
+                                                                                  rbf_tol=self.rbf_tol,
+                                                                                  memmap_dir=self.memmap_dir,
+                                                                                  precision=self.precision))
+                        self.__init__(numerator=merged_num, denominator=merged_den, locs=locs, meta=meta,
+                                      rbf_width=self.rbf_width, blur_method=self.blur_method, rbf_tol=self.rbf_tol,
+                                      n_jobs=self.n_jobs, memmap_dir=self.memmap_dir, precision=self.precision,
+                                      n_subs=len(data))
 
             if isinstance(data, six.string_types):
                 data = load(data)
@@ -132,44 +218,68 @@ class Model(object):
 
             if isinstance(data, Model):
                 self.date_created = data.date_created
-                self.denominator = data.denominator
+                self.denominator = data._denominator
                 self.locs = data.locs
                 self.meta = data.meta
                 self.n_subs = data.n_subs
-                self.numerator = data.numerator
+                self.numerator = data._numerator
+                self.eigenvectors = data._eigenvectors
+                self.eigenvalues = data.eigenvalues
                 self.rbf_width = data.rbf_width
+                self.blur_method = data.blur_method
+                self.rbf_tol = data.rbf_tol
+                self.n_jobs = data.n_jobs
+                self.memmap_dir = data.memmap_dir
+                self.precision = data.precision
                 #self = copy.deepcopy(data)
                 n_subs = self.n_subs
             elif isinstance(data, Brain):
                 corrmat = _get_corrmat(data)
-                self.__init__(data=corrmat, locs=data.get_locs(), n_subs=1)
+                self.__init__(data=corrmat, locs=data.get_locs(), blur_method=self.blur_method, rbf_tol=self.rbf_tol,
+                              n_jobs=self.n_jobs, memmap_dir=self.memmap_dir, precision=self.precision, n_subs=1)
             elif isinstance(data, np.ndarray):
                 assert not (locs is None), 'must specify model locations'
                 assert locs.shape[0] == data.shape[0], 'number of locations must match the size of the given correlation matrix'
 
                 self.locs = locs
                 self.numerator = _to_log_complex(_r2z(data))
-                self.denominator = np.zeros_like(self.numerator, dtype=np.float32)
+                self.denominator = np.zeros_like(self._numerator, dtype=np.float32)
 
         if not ((numerator is None) or (denominator is None)):
-            assert numerator.shape[0] == numerator.shape[1], 'numerator must be a square matrix'
-            assert denominator.shape[0] == denominator.shape[1], 'denominator must be a square matrix'
+            #full matrices are packed into their upper triangles; packed upper triangles (e.g. from .mo files) are used
+            #as is
+            if np.ndim(numerator) == 2:
+                assert numerator.shape[0] == numerator.shape[1], 'numerator must be a square matrix'
+                numerator = _pack_triu(numerator)
+            if np.ndim(denominator) == 2:
+                assert denominator.shape[0] == denominator.shape[1], 'denominator must be a square matrix'
+                denominator = _pack_triu(denominator)
             assert numerator.shape[0] == denominator.shape[0], 'numerator and denominator must be the same shape'
             assert not (locs is None), 'must specify model locations'
-            assert locs.shape[0] == numerator.shape[0], 'number of locations must match the size of the numerator ' \
-                                                        'and denominator matrices'
+            assert locs.shape[0] == _packed_n(numerator.shape[0]), 'number of locations must match the size of the ' \
+                                                                   'numerator and denominator matrices'
 
-            if (self.numerator is None) or (self.denominator is None):
+            if (self._numerator is None) or (self._denominator is None):
                 self.numerator = numerator
                 self.denominator = denominator
             else: #numerator and denominator may have already been inferred data; effectively the user has now passed in *two* sets of data
-                self._set_numerator(np.logaddexp(self.numerator.real, numerator.real),
-                                    np.logaddexp(self.numerator.imag, numerator.imag))
-                self.denominator = np.logaddexp(self.denominator, denominator)
+                self._set_numerator(np.logaddexp(self._numerator.real, numerator.real),
+                                    np.logaddexp(self._numerator.imag, numerator.imag))
+                self.denominator = np.logaddexp(self._denominator, denominator)
 
             self.locs = locs
             self.n_subs += n_subs
 
+        if not ((eigenvectors is None) or (eigenvalues is None)):
+            assert (self._numerator is None) and (self._denominator is None), \
+                'reduced models do not have a numerator or denominator'
+            assert not (locs is None), 'must specify model locations'
+            assert locs.shape[0] == eigenvectors.shape[0], 'number of locations must match the number of rows of the ' \
+                                                          'eigenvectors'
+            self.eigenvectors = eigenvectors
+            self.eigenvalues = np.asarray(eigenvalues, dtype=np.float64)
+            self.locs = locs
+
         if not (template is None): #blur correlation matrix out to template locations
             if not (locs is None):
                 warnings.warn('Argument ''locs'' will be ignored in favor of the provided Nifti template')
@@ -177,14 +287,14 @@ class Model(object):
                 template = load(template)
             assert type(template) == Nifti, 'template must be a Nifti object or a path to a Nifti object'
             bo = Brain(template)
-            rbf_weights = _log_rbf(bo.get_locs(), self.locs, width=self.rbf_width)
-            self.numerator, self.denominator = _blur_corrmat(self.get_model(z_transform=True), rbf_weights)
-            self.locs = bo.get_locs()
+            template_locs, tmp = _unique(bo.get_locs())
+            self.numerator, self.denominator = self._blur(template_locs, width=self.rbf_width)
+            self.locs = template_locs
         elif not (locs is None): #blur correlation matrix out to locs
             if (isinstance(data, Brain) or isinstance(data, Model)): #self.locs may now conflict with locs
                 if not ((locs.shape[0] == self.locs.shape[0]) and np.allclose(locs, self.locs)):
-                    rbf_weights = _log_rbf(locs, self.locs, width=self.rbf_width)
-                    self.numerator, self.denominator = _blur_corrmat(self.get_model(z_transform=True), rbf_weights)
+                    locs, tmp = _unique(locs)
+                    self.numerator, self.denominator = self._blur(locs, width=self.rbf_width)
                     self.locs = locs
         elif self.locs is None:
             self.locs = locs
@@ -192,10 +302,8 @@ class Model(object):
         assert not (self.locs is None), 'Must specify model locations directly via locs argument, or indirectly via a Model or Brain object (or both)'
 
         #sort locations and force them to be unique
-        self.locs, loc_inds = _unique(self.locs)
-        self.numerator = self.numerator[loc_inds, :][:, loc_inds]
-        self.denominator = self.denominator[loc_inds, :][:, loc_inds]
-        self.n_locs = self.locs.shape[0]
+        self._sort_locs()
+        self._cast()
 
         if not type(self.locs) == pd.DataFrame:
             self.locs = pd.DataFrame(data=self.locs, columns=['x', 'y', 'z'])
@@ -206,20 +314,132 @@ class Model(object):
         self.n_locs = self.locs.shape[0]
         self.n_subs = n_subs
 
+        #unchanged copies of a model share its (read-only) recovered correlation matrices and reconstruction operators
+        if isinstance(data, Model) and (self._numerator is data._numerator) and \
+                (self._denominator is data._denominator) and (self._eigenvectors is data._eigenvectors) and np.array_equal(self.locs.as_matrix(), data.locs.as_matrix()):
+            self._model_cache = dict(data._model_cache)
+            self._fingerprint = data._fingerprint
+
         if not (save is None):
             if type(save) == str:
                 self.save(save)
             else:
                 warnings.warn('bad filename, cannot save to disk: ' + str(save))
 
-    def get_model(self, z_transform=False):
-        """ Returns a copy of the model in the form of a correlation matrix"""
-        if (self.numerator is None) or (self.denominator is None):
-            m = np.eye(self.n_locs)
+    @property
+    def numerator(self):
+        """
+        The (log) numerator, expanded from its packed upper triangle into a full locations x locations matrix.  The
+        expanded matrix is a read-only copy, so changing it in place raises an error rather than silently leaving the
+        model unchanged.
+        """
+        if self._numerator is None:
+            return None
+        numerator = _unpack_triu(self._numerator)
+        numerator.flags.writeable = False
+        return numerator
+
+    @numerator.setter
+    def numerator(self, numerator):
+        if (numerator is None) or (np.ndim(numerator) == 1):
+            self._numerator = numerator
         else:
-            m = _recover_model(self.numerator, self.denominator, z_transform=z_transform)
-            m[np.isnan(m)] = 0
-        return m
+            self._numerator = _pack_triu(numerator)
+        self._reset_cache()
+
+    @property
+    def denominator(self):
+        """
+        The (log) denominator, expanded from its packed upper triangle into a full locations x locations matrix (a
+        read-only copy, like the numerator)
+        """
+        if self._denominator is None:
+            return None
+        denominator = _unpack_triu(self._denominator)
+        denominator.flags.writeable = False
+        return denominator
+
+    @denominator.setter
+    def denominator(self, denominator):
+        if (denominator is None) or (np.ndim(denominator) == 1):
+            self._denominator = denominator
+        else:
+            self._denominator = _pack_triu(denominator)
+        self._reset_cache()
+
+    @property
+    def eigenvectors(self):
+        """
+        Leading eigenvectors of the model's correlation matrix (reduced models only; see reduce)
+        """
+        return self._eigenvectors
+
+    @eigenvectors.setter
+    def eigenvectors(self, eigenvectors):
+        self._eigenvectors = eigenvectors
+        self._reset_cache()
+
+    @property
+    def locs(self):
+        """
+        The model's locations
+        """
+        return self._locs
+
+    @locs.setter
+    def locs(self, locs):
+        self._locs = locs
+        self._reset_cache()
+
+    def _reset_cache(self):
+        """
+        Internal function for clearing the cached recovered model (see get_model), and giving the model a new
+        fingerprint, whenever its numerator, denominator or locations are replaced.  The fingerprint identifies the
+        model's current contents (e.g. in the reconstruction operator cache).
+        """
+        self._model_cache = {}
+        self._fingerprint = uuid.uuid4().hex
+
+    def get_model(self, z_transform=False, copy=True):
+        """
+        Returns the model in the form of a correlation matrix
+
+        The recovered matrix is cached (separately for each value of z_transform) until the model's numerator,
+        denominator or locations are replaced.  (Changing the numerator or denominator arrays in place does not clear
+        the cache.)
+
+        Parameters
+        ----------
+        z_transform : bool
+            If True, return the Fisher z-transformed correlation matrix (default: False)
+
+        copy : bool
+            If True (default), return a copy of the cached matrix.  If False, return a read-only view of the cached
+            matrix, which avoids copying large models.
+
+        Returns
+        ----------
+        m : Numpy array
+            Locations x locations correlation matrix
+        """
+        z_transform = bool(z_transform)
+        if not (z_transform in self._model_cache):
+            if not (self._eigenvectors is None):
+                m = _low_rank_corr(self._eigenvectors, self.eigenvalues)
+                if z_transform:
+                    m = _r2z(m)
+            elif (self._numerator is None) or (self._denominator is None):
+                m = np.eye(self.n_locs)
+            else:
+                m = _recover_model(self._numerator, self._denominator, z_transform=z_transform)
+                m[np.isnan(m)] = 0
+            m.flags.writeable = False
+            self._model_cache[z_transform] = m
+
+        if copy:
+            return self._model_cache[z_transform].copy()
+        else:
+            return self._model_cache[z_transform].view()
 
     def get_locs(self):
         """ Returns the locations in the model
@@ -257,25 +477,129 @@ class Model(object):
 
         if np.all(new_locs_in_self):
             inds = _count_overlapping(new_locs, self.get_locs())
+            if np.all(inds):
+                #nothing to do (this also keeps the cached model and the model's fingerprint)
+                return
             self.locs = self.locs.iloc[inds, :]
             self.n_locs = self.locs.shape[0]
-            self.numerator = self.numerator[inds, :][:, inds]
-            self.denominator = self.denominator[inds, :][:, inds]
+            self._take(np.where(inds)[0])
             return
         else:
-            rbf_weights = _log_rbf(new_locs, self.get_locs())
-            self.numerator, self.denominator = _blur_corrmat(self.get_model(z_transform=True), rbf_weights)
+            #only the rows and columns of the added locations are blurred; the rest are copied from the current model
+            self.numerator, self.denominator = self._blur(new_locs, width=20)
             self.locs = new_locs
 
+        self._sort_locs()
+
+    def _sort_locs(self):
+        """
+        Internal function for sorting the model's locations and forcing them to be unique.  (Already-sorted
+        numerators and denominators, including memory-mapped ones, are left as is.)
+        """
+        if self._eigenvectors is None:
+            n = _packed_n(self._numerator.shape[0])
+        else:
+            n = self._eigenvectors.shape[0]
         self.locs, loc_inds = _unique(self.locs)
-        self.numerator = self.numerator[loc_inds, :][:, loc_inds]
-        self.denominator = self.denominator[loc_inds, :][:, loc_inds]
+        if not np.array_equal(loc_inds, np.arange(n)):
+            self._take(loc_inds)
         self.n_locs = self.locs.shape[0]
 
+    def _take(self, inds):
+        """
+        Internal function for keeping (in the given order) the given locations' entries of the stored model (the
+        packed numerator and denominator, or the eigenvectors of reduced models).  The locations aren't changed.
+        """
+        if self._eigenvectors is None:
+            self.numerator = _packed_take(self._numerator, inds)
+            self.denominator = _packed_take(self._denominator, inds)
+        else:
+            self.eigenvectors = self._eigenvectors[inds, :]
 
+    def _cast(self):
+        """
+        Internal function for storing the numerator and denominator at the model's precision
+        """
+        dtype = np.dtype(self.precision)
+        if not (self._numerator is None):
+            self.numerator = self._numerator.astype(np.result_type(dtype, np.complex64), copy=False)
+        if not (self._denominator is None):
+            self.denominator = self._denominator.astype(dtype, copy=False)
+        if not (self._eigenvectors is None):
+            self.eigenvectors = self._eigenvectors.astype(dtype, copy=False)
+
+    def _check_blurrable(self):
+        """
+        Internal function that raises a ValueError if the model is reduced (reduced models can't be blurred out to new
+        locations)
+        """
+        if not (self._eigenvectors is None):
+            raise ValueError('Reduced models cannot be blurred out to new locations.  Use nearest_neighbor=True (or '
+                             'include the new locations, with set_locs, before reducing the model).')
+
+    def _blur(self, new_locs, width):
+        """
+        Internal function for blurring the model out to new locations (using the model's blur settings).  Returns the
+        blurred numerator and denominator (as packed upper triangles).  New locations that are already in the model are found with a hash index
+        of the model's locations, and their correlations are copied rather than blurred.
+
+        Expansions are cached (see set_expansion_cache), keyed by the model's contents, the new locations and the blur
+        settings, so blurring the same model out to the same locations again (e.g. for another patient with the same
+        electrode locations) reuses the earlier expansion.  Cached numerators and denominators are read-only.
+        Expansions of memory-mapped models (see memmap_dir) aren't kept in the in-memory cache, so that their files
+        are still deleted once no model uses them anymore.
+        """
+        self._check_blurrable()
+        new_locs = np.asarray(new_locs, dtype=np.float64)
+        key = (self._hash(), hashlib.sha1(np.ascontiguousarray(new_locs)).hexdigest(), new_locs.shape, width,
+               self.blur_method, self.rbf_tol, self.precision, self.memmap_dir)
+
+        in_memory = self.memmap_dir is None
+        expansion = _expansion_cache.get(key) if in_memory else None
+        if (expansion is None) and not (_expansion_cache_dir is None):
+            expansion = _load_npy_pair(_expansion_cache_dir, _expansion_name(key), mmap_mode='r')
+            if in_memory and not (expansion is None):
+                _expansion_cache.put(key, expansion)
+        if not (expansion is None):
+            return expansion
+
+        if self.rbf_tol is None:
+            rbf_weights = _log_rbf(new_locs, self.get_locs(), width=width)
+        else:
+            rbf_weights = _sparse_rbf(new_locs, self.get_locs(), width=width, tol=self.rbf_tol)
+        expansion = _blur_corrmat(self.get_model(z_transform=True, copy=False), rbf_weights, method=self.blur_method,
+                                  n_jobs=self.n_jobs, memmap_dir=self.memmap_dir,
+                                  source_inds=_loc_index(self.get_locs(), new_locs), dtype=np.dtype(self.precision),
+                                  packed=True)
+        for x in expansion:
+            x.flags.writeable = False
+        if in_memory:
+            _expansion_cache.put(key, expansion)
+        if not (_expansion_cache_dir is None):
+            _save_npy_pair(_expansion_cache_dir, _expansion_name(key), expansion)
+        return expansion
+
+    def _hash(self):
+        """
+        Internal function for hashing the model's numerator, denominator and locations.  Unlike the fingerprint, the
+        hash only depends on the model's contents (so it's the same for copies of a model, or a model that's loaded
+        again from disk).  The hash is cached until the model's numerator, denominator or locations are replaced.
+        """
+        if not ('hash' in self._model_cache):
+            h = hashlib.sha1()
+            for x in (self._numerator, self._denominator, self._eigenvectors, self.eigenvalues,
+                      np.asarray(self.locs.as_matrix(), dtype=np.float64)):
+                if x is None:
+                    continue
+                x = np.ravel(x)
+                for start in range(0, x.shape[0], 2 ** 20):
+                    h.update(np.ascontiguousarray(x[start:(start + 2 ** 20)]))
+            self._model_cache['hash'] = h.hexdigest()
+        return self._model_cache['hash']
 
     def predict(self, bo, nearest_neighbor=False, match_threshold='auto',
-                force_update=False, force_include_bo_locs=True, preprocess='zscore', recon_loc_inds=None):
+                force_update=False, force_include_bo_locs=True, preprocess='zscore', recon_loc_inds=None,
+                solver='pinv', ridge=0, rcond=1e-15, save=None):
         """
         Takes a brain object and a 'full' covariance model, fills in all
         electrode timeseries for all missing locations and returns the new brain
@@ -303,8 +627,32 @@ class Model(object):
         preprocess : 'zscore' or None
             The predict algorithm requires the data to be zscored.  However, if
             your data are already zscored you can bypass this by setting to None.
-        recon_at_loc : electrode ind or None
-            Index for estimated location in model (location in unknown_inds)
+        recon_loc_inds : list of ints or None
+            If specified, only reconstruct activity at these locations (indices
+            into the model's locations that aren't in the brain object).  Only
+            the requested locations (and the brain object's locations) are
+            blurred and solved for, so the cost scales with the number of
+            requested locations, and the model itself is left unchanged.  If
+            None (default), activity is reconstructed at every model location.
+        solver : 'pinv', 'cholesky' or 'eigh'
+            How to solve for the reconstruction weights, given the correlations
+            between the patient's electrodes: 'pinv' (default) uses the
+            pseudo-inverse, 'cholesky' uses a (much faster) Cholesky
+            factorization, and 'eigh' uses a truncated eigendecomposition.  See
+            supereeg.ReconstructionOperator for details.
+        ridge : non-negative scalar
+            Ridge regularization added to the diagonal of the electrodes'
+            correlation matrix before solving (default: 0).  Small values (e.g.
+            0.01) improve the conditioning of the 'cholesky' solver.
+        rcond : positive scalar
+            Cutoff for small (relative) singular values or eigenvalues used by
+            the 'pinv' and 'eigh' solvers (default: 1e-15)
+        save : str or None
+            If specified, the reconstructions are written to this .bo file one
+            chunk at a time (so they never need to fit in memory), and the
+            returned brain object reads its data from the file (see the lazy
+            option of supereeg.load).  If None (default), the reconstructions
+            are returned in memory.
 
         Returns
         ----------
@@ -312,6 +660,149 @@ class Model(object):
             New brain data object with missing electrode locations filled in
         """
 
+        bor, mo, recon_loc_inds, recon_loc = self._predict_setup(bo, nearest_neighbor=nearest_neighbor,
+                                                                 match_threshold=match_threshold,
+                                                                 force_update=force_update,
+                                                                 force_include_bo_locs=force_include_bo_locs,
+                                                                 recon_loc_inds=recon_loc_inds)
+
+        if recon_loc_inds is None:
+            loc_labels = _loc_labels(_count_overlapping(bor.get_locs(), mo.get_locs()))
+            recon_loc = mo.locs
+        else:
+            loc_labels = _loc_labels(np.zeros(len(recon_loc_inds), dtype=bool))
+
+        if not (save is None):
+            from .load import load
+            chunks = _timeseries_recon_chunks(bor, mo, preprocess=preprocess, recon_loc_inds=recon_loc_inds,
+                                              solver=solver, ridge=ridge, rcond=rcond)
+            fname = _save_chunks(save, chunks, bor.data.shape[0], recon_loc, bor.sessions, bor.sample_rate,
+                                 label=loc_labels)
+            return load(fname, lazy=True)
+
+        activations = _timeseries_recon(bor, mo, preprocess=preprocess, recon_loc_inds=recon_loc_inds, solver=solver,
+                                        ridge=ridge, rcond=rcond)
+
+        return Brain(data=activations, locs=recon_loc, sessions=bor.sessions, sample_rate=bor.sample_rate,
+                         label=loc_labels, filter=None)
+
+    def predict_many(self, bos, n_jobs=1, save_dir=None, **kwargs):
+        """
+        Fills in the missing electrode timeseries for each of a list of brain objects
+
+        Each brain object is predicted (as in predict) using the model as it is now, so the results don't depend on
+        the order in which the brain objects are processed, and the model itself isn't changed.  The model's
+        correlation matrix is recovered once and shared by every prediction; with n_jobs > 1, the worker processes
+        inherit the model when they are forked (rather than receiving a pickled copy with every task).  The largest
+        brain objects are scheduled first, so that no worker is left with one large patient at the end.
+
+        Parameters
+        ----------
+        bos : list of supereeg.Brain objects (or paths to .bo files)
+            The brain objects to predict.  Brain objects passed as paths are loaded by the worker that predicts them.
+        n_jobs : int
+            Number of worker processes (default: 1).  -1 uses every available core.
+        save_dir : str or None
+            If specified, each prediction is saved to save_dir (as <name>.bo, where name is the name of the brain
+            object's file, or bo_<index> for brain objects that aren't passed as paths) as soon as it's done, and the
+            file names are returned instead of the predicted brain objects.  If None (default), the predicted brain
+            objects are returned.
+        kwargs :
+            Passed to predict (e.g. nearest_neighbor, recon_loc_inds, solver, ridge)
+
+        Returns
+        ----------
+        results : list of supereeg.Brain objects or str
+            The predicted brain objects (or the names of the files they were saved to), in the same order as bos
+        """
+        global _shared_model
+
+        if save_dir is None:
+            fnames = [None] * len(bos)
+        else:
+            if not os.path.exists(save_dir):
+                os.makedirs(save_dir)
+            fnames = []
+            for i, bo in enumerate(bos):
+                if isinstance(bo, six.string_types):
+                    name = os.path.splitext(os.path.basename(bo))[0]
+                else:
+                    name = 'bo_' + str(i)
+                fnames.append(os.path.join(save_dir, name + '.bo'))
+
+        #largest first (ties are kept in their original order)
+        order = np.argsort(-np.array([_brain_size(bo) for bo in bos]), kind='mergesort')
+
+        #recover (and hash) the model once, before any workers are forked
+        if self.eigenvectors is None:
+            self.get_model(z_transform=True, copy=False)
+        self._hash()
+
+        if n_jobs == 1:
+            results = [_predict_one(self, bos[i], fnames[i], kwargs) for i in order]
+        else:
+            shared = _fork_available()
+            _shared_model = self
+            try:
+                results = Parallel(n_jobs=n_jobs, backend='multiprocessing')(
+                    delayed(_predict_one)(None if shared else self, bos[i], fnames[i], kwargs) for i in order)
+            finally:
+                _shared_model = None
+
+        ordered = [None] * len(bos)
+        for i, x in zip(order, results):
+            ordered[i] = x
+        return ordered
+
+    def predict_stream(self, bo, nearest_neighbor=False, match_threshold='auto', force_update=False,
+                       force_include_bo_locs=True, preprocess='zscore', recon_loc_inds=None, solver='pinv', ridge=0,
+                       rcond=1e-15, chunk_size=1000):
+        """
+        Generator version of predict, for recordings whose reconstructions are too large to hold in memory
+
+        Reconstructed timeseries are yielded one chunk (of at most chunk_size samples) at a time, so memory use scales
+        with chunk_size times the number of model locations rather than with the length of the recording.  Each
+        session is z-scored using statistics computed in a streaming pass over the session's (observed) data, so the
+        concatenated chunks match the data returned by predict.
+
+        Parameters
+        ----------
+        bo, nearest_neighbor, match_threshold, force_update, force_include_bo_locs, preprocess, recon_loc_inds, solver,
+        ridge, rcond :
+            See predict
+        chunk_size : int
+            Maximum number of samples per chunk (default: 1000).  Chunks never span sessions.
+
+        Returns
+        ----------
+        chunks : generator
+            Yields (session, (start, stop), data) tuples, where data is a samples x locations array of reconstructed
+            activity for samples start through stop - 1 of the given session.  Locations are in the same order as the
+            locations of the Brain object returned by predict (the model's locations, including the patient's
+            electrodes, or the requested recon_loc_inds).
+        """
+
+        bor, mo, recon_loc_inds, recon_loc = self._predict_setup(bo, nearest_neighbor=nearest_neighbor,
+                                                                 match_threshold=match_threshold,
+                                                                 force_update=force_update,
+                                                                 force_include_bo_locs=force_include_bo_locs,
+                                                                 recon_loc_inds=recon_loc_inds)
+
+        for session, inds, data in _timeseries_recon_chunks(bor, mo, chunk_size=chunk_size, preprocess=preprocess,
+                                                            recon_loc_inds=recon_loc_inds, solver=solver,
+                                                            ridge=ridge, rcond=rcond):
+            yield session, (int(inds[0]), int(inds[-1]) + 1), data
+
+    def _predict_setup(self, bo, nearest_neighbor=False, match_threshold='auto', force_update=False,
+                       force_include_bo_locs=True, recon_loc_inds=None):
+        """
+        Internal function for preparing the brain object and the model used by predict.  Returns the filtered brain
+        object, the model (blurred out to include the brain object's locations), and the indices (into the returned
+        model's unknown locations) and locations of the requested recon_loc_inds (or None, None).
+
+        If recon_loc_inds is specified, the returned model is a new model that only contains the brain object's
+        locations and the requested locations (and the original model isn't changed).
+        """
         if not isinstance(bo, Brain):
             bor = Brain(bo)
 
@@ -331,22 +822,94 @@ class Model(object):
         else:
             mo = self
 
-        #blur out model to include brain object locations
-        mo.set_locs(bor.get_locs(), force_include_bo_locs=force_include_bo_locs)
+        if (recon_loc_inds is None) or (len(np.ravel(recon_loc_inds)) == 0):
+            #blur out model to include brain object locations
+            mo.set_locs(bor.get_locs(), force_include_bo_locs=force_include_bo_locs)
+            return bor, mo, None, None
+
+        #only blur out the model to the brain object locations and the requested locations
+        recon_loc_inds = np.ravel(recon_loc_inds).astype(int)
+        unknown_locs = mo.get_locs()[~_count_overlapping(bor.get_locs(), mo.get_locs())]
+        recon_loc = unknown_locs.iloc[recon_loc_inds].as_matrix()
+        sub_locs, tmp = _unique(np.vstack((bor.get_locs().as_matrix(), recon_loc)))
+        if mo.eigenvectors is None:
+            numerator, denominator = mo._blur(sub_locs, width=20)
+            sub_mo = Model(numerator=numerator, denominator=denominator, locs=sub_locs, n_subs=mo.n_subs,
+                           meta=mo.meta, rbf_width=mo.rbf_width, blur_method=mo.blur_method, rbf_tol=mo.rbf_tol,
+                           n_jobs=mo.n_jobs, memmap_dir=mo.memmap_dir, precision=mo.precision)
+        else:
+            #reduced models can't be blurred, so every location must already be in the model
+            sub_inds = _loc_index(mo.get_locs(), sub_locs)
+            if np.any(sub_inds < 0):
+                mo._check_blurrable()
+            sub_mo = mo.get_slice(sub_inds)
 
-        activations = _timeseries_recon(bor, mo, preprocess=preprocess, recon_loc_inds=recon_loc_inds)
+        #the requested locations are the new model's only unknown locations; find their (sorted) positions
+        unique_recon_loc, tmp = _unique(recon_loc)
+        return bor, sub_mo, _loc_index(unique_recon_loc, recon_loc), np.atleast_2d(recon_loc)
 
-        if not recon_loc_inds:
-            loc_labels = np.array(['observed'] * len(mo.get_locs()))
-            loc_labels[~_count_overlapping(bor.get_locs(), mo.get_locs())] = ['reconstructed']
-            recon_loc = mo.locs
-        else:
-            recon_loc = np.atleast_2d(mo.get_locs().iloc[~_count_overlapping(bor.get_locs(), mo.get_locs())].iloc[recon_loc_inds[0]].as_matrix())
-            loc_labels = np.array(['reconstructed'] * len(list(recon_loc_inds)))
 
-        return Brain(data=activations, locs=recon_loc, sessions=bor.sessions, sample_rate=bor.sample_rate,
-                         label=loc_labels.tolist(), filter=None)
+    def cross_validate(self, bo, nearest_neighbor=False, match_threshold='auto', preprocess='zscore', ridge=0,
+                       rcond=1e-15):
+        """
+        Leave-one-electrode-out cross validation
+
+        Each of the brain object's electrodes is held out in turn and its activity is reconstructed (as in predict)
+        from the brain object's other electrodes.  This gives the same reconstructions as removing each electrode with
+        get_slice and calling predict, but the model is only blurred out to the brain object's locations once, and
+        the correlations between the electrodes are only inverted once: the weights for each held-out electrode are
+        recovered from the single inverse using block inverse identities.  The model isn't changed.
+
+        Parameters
+        ----------
+        bo : supereeg.Brain
+            Brain object whose electrodes are cross validated
+        nearest_neighbor, match_threshold, preprocess :
+            See predict
+        ridge : non-negative scalar
+            Ridge regularization added to the diagonal of the electrodes' correlation matrix (default: 0)
+        rcond : positive scalar
+            Cutoff for small (relative) singular values used when inverting the electrodes' correlation matrix
+            (default: 1e-15)
+
+        Returns
+        ----------
+        corrs : Numpy.ndarray
+            Correlation between each (filtered) electrode's observed activity and its reconstruction, in the same
+            order as the brain object's locations
+        """
+        from .reconstruction import _loo_weights
+
+        bor = bo.apply_filter(inplace=False)
+        if nearest_neighbor:
+            bor = _near_neighbor(bor, self, match_threshold=match_threshold)
 
+        if (preprocess == 'zscore') and (bor.data.shape[0] >= 3):
+            data = bor.get_zscore_data()
+        else:
+            data = bor.get_data().as_matrix()
+
+        #correlations between the electrodes (only the pairs of electrodes are blurred)
+        locs = bor.get_locs().as_matrix()
+        if self.eigenvectors is None:
+            elec_locs, tmp = _unique(locs)
+            numerator, denominator = self._blur(elec_locs, width=20)
+            inds = _loc_index(elec_locs, locs)
+            K = _z2r(_recover_model(numerator, denominator, z_transform=True))[inds, :][:, inds]
+        else:
+            #reduced models can't be blurred, so every electrode must already be in the model
+            inds = _loc_index(self.get_locs(), locs)
+            if np.any(inds < 0):
+                self._check_blurrable()
+            K = _low_rank_corr(self.eigenvectors[inds, :], self.eigenvalues)
+
+        #reconstruct every electrode at once, and z-score the reconstructions within each session (as in predict)
+        recon = np.dot(data, _loo_weights(K, ridge=ridge, rcond=rcond))
+        sessions = np.asarray(bor.sessions)
+        for session in np.unique(sessions):
+            s = sessions == session
+            recon[s, :] = zscore(recon[s, :])
+        return _corr_column(recon, data)
 
     def update(self, data, inplace=True):
         """
@@ -355,7 +918,8 @@ class Model(object):
         Parameters
         ----------
         data : supereeg.Brain, supereeg.Nifti, supereeg.Model (or a mixed list of these)
-            New data
+            New data.  If a list is passed, every model is expanded to the union of all of the models' locations and
+            the models are merged in a single pass (so every input is held in memory at once).
         inplace : bool
             Whether to run update in place or return a new model (default True).
 
@@ -364,6 +928,11 @@ class Model(object):
         model : supereeg.Model
             A new updated model object
         """
+        if not isinstance(data, (list, tuple)):
+            data = [data]
+        if not (self.eigenvectors is None) or any(isinstance(x, Model) and not (x.eigenvectors is None) for x in data):
+            raise ValueError('Reduced models cannot be updated.')
+
         if inplace:
             m1 = self
         else:
@@ -371,29 +940,42 @@ class Model(object):
 
         assert m1.meta['stable']==True, 'solution unstable'
 
-        m2 = Model(data)
-        locs = _union(m1.get_locs(), m2.get_locs())
-
-        m1.set_locs(locs)
-        m2.set_locs(locs)
+        if len(data) == 0:
+            if not inplace:
+                return m1
+            return
 
-        m1._set_numerator(np.logaddexp(m1.numerator.real, m2.numerator.real),
-                          np.logaddexp(m1.numerator.imag, m2.numerator.imag))
+        #compute the union of every model's locations once, and blur each model out to it in a single pass
+        models = [Model(x) for x in data]
+        locs = _union(m1.get_locs(), np.vstack([np.asarray(m.get_locs()) for m in models]))
+        for m in [m1] + models:
+            m.set_locs(locs)
+
+        #merge the packed upper triangles of all of the models with one stacked log-sum-exp reduction (written straight
+        #into new memory-mapped files for memory-mapped models)
+        everyone = [m1] + models
+        dtype = np.dtype(m1.precision)
+        numerator = _empty_array(m1.memmap_dir, 'numerator', np.result_type(dtype, np.complex64),
+                                 m1._numerator.shape)
+        _logsumexp_stack([m._numerator.real for m in everyone], out=numerator.real)
+        _logsumexp_stack([m._numerator.imag for m in everyone], out=numerator.imag)
         #simplify to ensure that each entry of the numerator has either a non-zero real part OR a non-zero imag part
         #(or neither).
-        n = _to_log_complex(_to_exp_real(m1.numerator))
-        m1._set_numerator(n.real, n.imag)
-        m1.denominator = np.logaddexp(m1.denominator, m2.denominator)
+        m1.numerator = _simplify_log_complex(numerator, out=numerator)
+        m1.denominator = _logsumexp_stack([m._denominator for m in everyone],
+                                          out=_empty_array(m1.memmap_dir, 'denominator', dtype, m1._denominator.shape))
         m1.locs = locs
         m1.n_locs = locs.shape[0]
-        m1.n_subs += m2.n_subs
 
-        #combine meta info
-        if not ((m1.meta is None) and (m2.meta is None)):
-            if m1.meta is None:
-                m1.meta = m2.meta
-            elif (type(m1.meta) == dict) and (type(m2.meta) == dict):
-                m1.meta.update(m2.meta)
+        for m2 in models:
+            m1.n_subs += m2.n_subs
+
+            #combine meta info
+            if not ((m1.meta is None) and (m2.meta is None)):
+                if m1.meta is None:
+                    m1.meta = m2.meta
+                elif (type(m1.meta) == dict) and (type(m2.meta) == dict):
+                    m1.meta.update(m2.meta)
 
         if not inplace:
             return m1
@@ -403,9 +985,10 @@ class Model(object):
         """
         Internal function for setting the numerator (deals with size mismatches)
         """
-        self.numerator = np.zeros_like(n_real, dtype=np.complex128)
-        self.numerator.real = n_real
-        self.numerator.imag = n_imag
+        numerator = np.zeros_like(n_real, dtype=np.result_type(np.dtype(self.precision), np.complex64))
+        numerator.real = n_real
+        numerator.imag = n_imag
+        self.numerator = numerator
 
 
     def info(self):
@@ -417,6 +1000,9 @@ class Model(object):
         print('Number of locations: ' + str(self.n_locs))
         print('Number of subjects: ' + str(self.n_subs))
         print('RBF width: ' + str(self.rbf_width))
+        print('Blur method: ' + str(self.blur_method))
+        print('RBF tolerance: ' + str(self.rbf_tol))
+        print('Precision: ' + str(self.precision))
         print('Date created: ' + str(self.date_created))
         print('Meta data: ' + str(self.meta))
 
@@ -438,7 +1024,7 @@ class Model(object):
             An axes object
         """
 
-        corr_mat = self.get_model(z_transform=False)
+        corr_mat = self.get_model(z_transform=False, copy=False)
 
         if np.shape(corr_mat)[0] < 2000:
             ax = sns.heatmap(corr_mat, cbar_kws = {'label': 'correlation'}, **kwargs)
@@ -468,12 +1054,80 @@ class Model(object):
         else:
             _plot_locs_hyp(locs, pdfpath)
 
-    def save(self, fname, compression='blosc'):
+    def reduce(self, rank=None, explained_variance=None, inplace=False):
+        """
+        Approximate the model by a truncated eigendecomposition of its correlation matrix
+
+        Reduced models store a locations x rank matrix of eigenvectors (and the corresponding eigenvalues) instead of
+        the locations x locations numerator and denominator, so they only need O(n_locs * rank) memory (and disk
+        space).  Predictions from reduced models are computed from the eigenvectors, without forming the full
+        correlation matrix.  The correlations between locations are approximated using the leading eigenvectors (the
+        diagonal is kept at 1).
+
+        Reduced models can't be updated or blurred out to new locations, so patients' electrodes need to be at model
+        locations (e.g. by using nearest_neighbor=True in predict).  Other locations can be added (with set_locs)
+        before the model is reduced.
+
+        Parameters
+        ----------
+        rank : int or None
+            Number of eigenvectors to keep
+        explained_variance : float or None
+            If specified (instead of rank), keep the fewest eigenvectors that explain at least this proportion (between
+            0 and 1) of the variance
+        inplace : bool
+            If True, reduce the model in place.  Otherwise (default), return a new reduced model.
+
+        Returns
+        ----------
+        model : supereeg.Model
+            The reduced model (if inplace is False)
+        """
+        assert (rank is None) != (explained_variance is None), 'must specify either rank or explained_variance'
+
+        if self.eigenvectors is None:
+            K = self.get_model(z_transform=False, copy=False)
+            n = K.shape[0]
+            if rank is None:
+                vals, vecs = eigh(K)
+            else:
+                #only compute the leading eigenvectors
+                k = max(1, min(int(rank), n))
+                try:
+                    vals, vecs = eigh(K, subset_by_index=[n - k, n - 1])
+                except TypeError: #older versions of scipy
+                    vals, vecs = eigh(K, eigvals=(n - k, n - 1))
+            order = np.argsort(vals)[::-1]
+            vals, vecs = vals[order], vecs[:, order]
+        else:
+            vals, vecs = self.eigenvalues, self.eigenvectors
+
+        if not (explained_variance is None):
+            #the total variance is the trace of the correlation matrix (the number of locations)
+            rank = np.searchsorted(np.cumsum(vals) / self.n_locs, explained_variance) + 1
+        vals = vals[:int(rank)]
+        vecs = np.ascontiguousarray(vecs[:, :int(rank)], dtype=np.dtype(self.precision))
+
+        if inplace:
+            self.numerator = None
+            self.denominator = None
+            self.eigenvectors = vecs
+            self.eigenvalues = vals
+        else:
+            return Model(eigenvectors=vecs, eigenvalues=vals, locs=self.locs, n_subs=self.n_subs, meta=self.meta,
+                         date_created=self.date_created, rbf_width=self.rbf_width, blur_method=self.blur_method,
+                         rbf_tol=self.rbf_tol, n_jobs=self.n_jobs, memmap_dir=self.memmap_dir,
+                         precision=self.precision)
+
+    def save(self, fname, compression='blosc', precision=None):
         """
         Save method for the model object
         The data will be saved as a 'mo' file, which is a dictionary containing
         the elements of a model object saved in the hd5 format using
-        `deepdish`.
+        `deepdish`.  The numerator and denominator are saved as packed upper
+        triangles (rather than as full locations x locations matrices, as in
+        files saved by earlier versions); use load(fname, field='numerator')
+        to read either one back as a full matrix.
 
         Parameters
         ----------
@@ -483,16 +1137,33 @@ class Model(object):
         compression : str
             The kind of compression to use.  See the deepdish documentation for
             options: http://deepdish.readthedocs.io/en/latest/api_io.html#deepdish.io.save
+        precision : 'float64', 'float32' or None
+            Floating point precision used to store the numerator and denominator
+            in the file (and recorded in the file, so that the loaded model uses
+            the same precision).  If None (default), the model's precision is used.
         """
 
+        if precision is None:
+            precision = self.precision
+        assert precision in ('float64', 'float32'), 'Unsupported precision: ' + str(precision)
+        dtype = np.dtype(precision)
+
+        def cast(x, dtype):
+            if x is None:
+                return None
+            return x.astype(dtype, copy=False)
+
         mo = {
-            'numerator' : self.numerator,
-            'denominator' : self.denominator,
+            'numerator' : cast(self._numerator, np.result_type(dtype, np.complex64)),
+            'denominator' : cast(self._denominator, dtype),
+            'eigenvectors' : cast(self._eigenvectors, dtype),
+            'eigenvalues' : self.eigenvalues,
             'locs' : self.locs,
             'n_subs' : self.n_subs,
             'meta' : self.meta,
             'date_created' : self.date_created,
-            'rbf_width' : self.rbf_width
+            'rbf_width' : self.rbf_width,
+            'precision' : precision
         }
 
         if fname[-3:]!='.mo':
@@ -516,23 +1187,29 @@ class Model(object):
             If True, indexes in place.
 
         """
-        numerator = self.numerator[loc_inds][:, loc_inds]
-        denominator = self.denominator[loc_inds][:, loc_inds]
-        locs = self.locs.iloc[loc_inds]
+        inds = np.atleast_1d(np.arange(self.n_locs)[loc_inds])
+        locs = self.locs.iloc[inds]
         n_subs = self.n_subs
         meta = self.meta
         date_created = time.strftime("%c")
 
         if inplace:
-            self.numerator = numerator
-            self.denominator = denominator
+            self._take(inds)
             self.locs = locs
+            self.n_locs = locs.shape[0]
             self.n_subs = n_subs
             self.meta = meta
             self.date_created = date_created
+        elif self._eigenvectors is None:
+            return Model(numerator=_packed_take(self._numerator, inds), denominator=_packed_take(self._denominator, inds),
+                         locs=locs, n_subs=n_subs, meta=meta, date_created=date_created, rbf_width=self.rbf_width,
+                         blur_method=self.blur_method, rbf_tol=self.rbf_tol, n_jobs=self.n_jobs,
+                         memmap_dir=self.memmap_dir, precision=self.precision)
         else:
-            return Model(numerator=numerator, denominator=denominator, locs=locs,
-                         n_subs=n_subs, meta=meta, date_created=date_created, rbf_width=self.rbf_width)
+            return Model(eigenvectors=self._eigenvectors[inds, :], eigenvalues=self.eigenvalues, locs=locs,
+                         n_subs=n_subs, meta=meta, date_created=date_created, rbf_width=self.rbf_width,
+                         blur_method=self.blur_method, rbf_tol=self.rbf_tol, n_jobs=self.n_jobs,
+                         memmap_dir=self.memmap_dir, precision=self.precision)
 
     def __add__(self, other):
         """
@@ -541,7 +1218,7 @@ class Model(object):
         conflict then the values from the first object are preferred.
         Parameters
         ----------
-        other: Model object to be added to the current object
+        other: Model object (or list of Model objects) to be added to the current object
         """
 
         return self.update(other, inplace=False)
@@ -578,15 +1255,196 @@ class Model(object):
         warnings.warn('solution unstable')
 
 
-        m1_z = m1.n_subs * m1.get_model(z_transform=True)
-        m2_z = m2.n_subs * m2.get_model(z_transform=True)
+        m1_z = m1.n_subs * m1.get_model(z_transform=True, copy=False)
+        m2_z = m2.n_subs * m2.get_model(z_transform=True, copy=False)
 
         m2_z[np.where(np.isnan(m2_z))] = 0
         np.fill_diagonal(m2_z, 1)
 
         return Model(data=_z2r(np.divide(np.subtract(m1_z,m2_z), (m1.n_subs-m2.n_subs))),
-                     locs=locs, n_subs=m1.n_subs - m2.n_subs, meta=meta, rbf_width=m1.rbf_width)
+                     locs=locs, n_subs=m1.n_subs - m2.n_subs, meta=meta, rbf_width=m1.rbf_width,
+                     precision=m1.precision)
+
+
+
+###################################
+# expansion cache
+###################################
+
+#blurred numerators and denominators for recently used (model, locations, blur settings) combinations
+_expansion_cache = LRUCache(maxsize=None, maxbytes=2 ** 28)
+_expansion_cache_dir = None
+
+def set_expansion_cache(maxbytes=2 ** 28, cache_dir=None):
+    """
+    Configure the cache of blurred model expansions
+
+    Whenever a model is blurred out to a new set of locations (e.g. to include
+    a patient's electrodes in predict), the blurred numerator and denominator
+    are cached, so that blurring the same model out to the same locations
+    again reuses them.  Least recently used expansions are discarded once the
+    cache exceeds its memory budget.  Changing the settings clears the cache.
+    Expansions of memory-mapped models (see the memmap_dir option of Model)
+    are only cached in cache_dir, so their memory-mapped files can be deleted
+    as soon as no model uses them anymore.
 
+    Parameters
+    ----------
+    maxbytes : int
+        Memory budget (in bytes) for cached expansions (default: 2 ** 28, i.e.
+        256 MB).  Set to 0 to disable the (in-memory) cache.
+    cache_dir : str or None
+        If specified, expansions are also saved to (memory-mapped) .npy files
+        in this directory, so they can be reused in later sessions.  Files in
+        this directory are not limited by maxbytes, and need to be deleted
+        manually.  If None (default), expansions are only cached in memory.
+    """
+    global _expansion_cache, _expansion_cache_dir
+    _expansion_cache = LRUCache(maxsize=None, maxbytes=maxbytes)
+    _expansion_cache_dir = cache_dir
+
+def clear_expansion_cache():
+    """
+    Discard every (in-memory) cached expansion
+    """
+    _expansion_cache.clear()
+
+def _expansion_name(key):
+    """Name of the cached numerator and denominator files for an expansion (see _save_npy_pair)"""
+    return hashlib.sha1(repr(key).encode('utf-8')).hexdigest()
+
+
+###################################
+# helper functions for parallel model construction
+###################################
+
+def _data_locs(x):
+    """Locations of a Brain, Model or Nifti object (or of the object saved in a file)"""
+    from .load import load, _load_field
+
+    if isinstance(x, six.string_types):
+        if x.split('.')[-1] == 'mo':
+            return np.asarray(_load_field(x, 'locs'))
+        x = load(x)
+    if isinstance(x, Nifti):
+        x = Brain(x)
+    return x.get_locs().as_matrix()
+
+def _subject_contribution(x, locs, template, kwargs, detach=False):
+    """
+    Packed numerator and denominator (along with the locations and meta data) of a single subject's model.  If detach
+    is True, memory-mapped results are returned as the names of their files (see _untrack_memmap), so that they can be
+    passed back from worker processes and then reopened with _attach_memmap.
+    """
+    mo = Model(data=x, locs=locs, template=template, n_jobs=1, **kwargs)
+    numerator, denominator = mo._numerator, mo._denominator
+    if detach and not (mo.memmap_dir is None):
+        numerator, denominator = _untrack_memmap(numerator), _untrack_memmap(denominator)
+    return numerator, denominator, mo.locs, mo.meta
+
+def _merge_contributions(a, b, memmap_dir=None):
+    """Log-sum-exp merge of two (numerator, denominator) pairs at the same locations (into new memory-mapped files if
+    memmap_dir is specified)"""
+    numerator = _empty_array(memmap_dir, 'numerator', a[0].dtype, a[0].shape)
+    np.logaddexp(a[0].real, b[0].real, out=numerator.real)
+    np.logaddexp(a[0].imag, b[0].imag, out=numerator.imag)
+    denominator = _empty_array(memmap_dir, 'denominator', a[1].dtype, a[1].shape)
+    np.logaddexp(a[1], b[1], out=denominator)
+    return numerator, denominator
+
+def _tree_reduce(items, merge):
+    """
+    Combine a sequence of items with a balanced tree of pairwise merges.  Items are merged as they arrive (like the
+    carries of a binary counter), so at most log2(len(items)) + 1 partial results are held in memory at a time.
+    """
+    stack = []
+    for x in items:
+        size = 1
+        while (len(stack) > 0) and (stack[-1][0] == size):
+            prev_size, prev = stack.pop()
+            x = merge(prev, x)
+            size += prev_size
+        stack.append((size, x))
+
+    result = None
+    while len(stack) > 0:
+        size, x = stack.pop()
+        if result is None:
+            result = x
+        else:
+            result = merge(x, result)
+    return result
+
+def _build_parallel(data, locs, template, n_jobs, kwargs):
+    """
+    Build a model from a list of objects (see Model), computing each subject's model in a separate worker process.
+    Returns the (simplified) packed numerator and denominator, along with the model's locations and meta data.
+    """
+    if n_jobs < 0:
+        n_workers = max(1, cpu_count() + 1 + n_jobs)
+    else:
+        n_workers = n_jobs
+
+    info = {'locs': None, 'meta': kwargs['meta']}
+    def contributions():
+        #subjects are processed n_workers at a time, so that only a few subjects' results are held in memory
+        with Parallel(n_jobs=n_jobs) as parallel:
+            for start in range(0, len(data), n_workers):
+                for numerator, denominator, sub_locs, meta in parallel(
+                        delayed(_subject_contribution)(x, locs, template, kwargs, detach=True)
+                        for x in data[start:(start + n_workers)]):
+                    if info['locs'] is None:
+                        info['locs'] = sub_locs
+                    if info['meta'] is None:
+                        info['meta'] = meta
+                    elif (type(info['meta']) == dict) and (type(meta) == dict):
+                        info['meta'].update(meta)
+                    yield _attach_memmap(numerator), _attach_memmap(denominator)
+
+    memmap_dir = kwargs.get('memmap_dir', None)
+    numerator, denominator = _tree_reduce(contributions(),
+                                          lambda a, b: _merge_contributions(a, b, memmap_dir=memmap_dir))
+    if memmap_dir is None:
+        return _simplify_log_complex(numerator), denominator, info['locs'], info['meta']
+    return _simplify_log_complex(numerator, out=numerator), denominator, info['locs'], info['meta']
+
+
+###################################
+# helper functions for predict_many
+###################################
+
+#model shared with (forked) predict_many workers
+_shared_model = None
+
+def _fork_available():
+    """Returns True if worker processes are forked (and therefore inherit _shared_model)"""
+    import multiprocessing
+    try:
+        return multiprocessing.get_start_method() == 'fork'
+    except AttributeError: #python 2 always forks on posix systems
+        return os.name == 'posix'
+
+def _brain_size(bo):
+    """Approximate size of a brain object (or of a .bo file), used to schedule the largest predictions first"""
+    if isinstance(bo, six.string_types):
+        return os.path.getsize(bo)
+    return bo.data.shape[0] * bo.data.shape[1]
+
+def _predict_one(mo, bo, fname, kwargs):
+    """Predicts a single brain object (for predict_many) using a copy of the given (or shared) model"""
+    from .load import load
+
+    if mo is None:
+        mo = _shared_model
+    if isinstance(bo, six.string_types):
+        bo = load(bo)
+
+    #predict may blur out (or update) the model, so predict using a copy that shares the original model's data
+    bo_p = Model(mo).predict(bo, **kwargs)
+    if fname is None:
+        return bo_p
+    bo_p.save(fname)
+    return fname
 
 
 ###################################
@@ -668,7 +1526,17 @@ def _force_update(mo, bo, width=20):
 def _recover_model(num, denom, z_transform=False):
     warnings.simplefilter('ignore')
 
-    m = np.divide(_to_exp_real(num), np.exp(denom)) #numerator and denominator are in log units
+    #numerator and denominator are in log units.  subtract the denominator before exponentiating (in double precision),
+    #so that large numerators and denominators can't overflow.
+    denom = np.asarray(denom, dtype=np.float64)
+    if np.any(np.iscomplex(num)):
+        m = np.exp(num.real - denom) - np.exp(num.imag - denom)
+    else:
+        m = np.exp(np.real(num) - denom)
+
+    #packed upper triangles (see _pack_triu) are only expanded once they've been recovered
+    if np.ndim(m) == 1:
+        m = _unpack_triu(m)
     if z_transform:
         np.fill_diagonal(m, np.inf)
         return m
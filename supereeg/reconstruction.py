@@ -0,0 +1,329 @@
+from __future__ import division
+from __future__ import print_function
+import time
+import warnings
+import numpy as np
+from collections import deque
+from scipy.linalg import cho_factor, cho_solve, eigh, LinAlgError
+from .helpers import _z2r, _low_rank_corr, _loc_labels, known_unknown
+from .cache import LRUCache
+
+#reconstruction operators for recently used (model, electrode locations) pairs
+_operator_cache = LRUCache(maxsize=8)
+
+#high resolution timer (for OnlinePredictor latencies)
+_clock = getattr(time, 'perf_counter', time.time)
+
+
+class ReconstructionOperator(object):
+    """
+    Reconstruction operator for the supereeg package
+
+    Maps activity recorded at a set of known (electrode) locations onto the
+    remaining (unknown) locations of a model.  The reconstruction weights
+    (Kaa^-1 * Kab) are computed once, by solving the known locations' system
+    against Kab (without forming Kaa^-1), so reconstructing each chunk of data
+    takes a single matrix product.  Use ReconstructionOperator.from_model to
+    get a (cached) operator for a model and a set of electrode locations.
+
+    Parameters
+    ----------
+    K : Numpy.ndarray or tuple
+        A locations x locations correlation matrix, or (for reduced models; see
+        supereeg.Model.reduce) a tuple containing the locations x rank matrix
+        of the correlation matrix's leading eigenvectors and the corresponding
+        eigenvalues.  Only the blocks of the correlation matrix that are needed
+        are recovered from the eigenvectors.
+    known_inds : list
+        Indices (into K) of the known locations
+    unknown_inds : list
+        Indices (into K) of the unknown locations
+    solver : 'pinv', 'cholesky' or 'eigh'
+        How to solve the known locations' system:
+
+            'pinv' (default) : Moore-Penrose pseudo-inverse (via the SVD).
+
+            'cholesky' : Cholesky factorization (much faster).  Falls back to
+            'pinv' (with a warning) if the system isn't positive definite; use
+            ridge to regularize ill-conditioned systems.
+
+            'eigh' : eigendecomposition, discarding eigenvalues smaller than
+            rcond times the largest eigenvalue.
+    ridge : non-negative scalar
+        Ridge (shrinkage) added to the diagonal of Kaa before solving
+        (default: 0)
+    rcond : positive scalar
+        Cutoff for small (relative) singular values or eigenvalues, used by the
+        'pinv' and 'eigh' solvers (default: 1e-15)
+
+    Attributes
+    ----------
+    known_inds : list
+        Indices of the known locations
+    unknown_inds : list
+        Indices of the unknown locations
+    n_locs : int
+        Total number of locations
+    weights : Numpy.ndarray
+        A known locations x unknown locations matrix of reconstruction weights
+    """
+    def __init__(self, K, known_inds, unknown_inds, solver='pinv', ridge=0, rcond=1e-15):
+        self.known_inds = known_inds
+        self.unknown_inds = unknown_inds
+        if isinstance(K, tuple):
+            vecs, vals = K
+            self.n_locs = vecs.shape[0]
+            Kaa = _low_rank_corr(vecs[known_inds, :], vals)
+            Kab = _low_rank_corr(vecs[known_inds, :], vals, vecs[unknown_inds, :])
+        else:
+            self.n_locs = K.shape[0]
+            Kaa = K[known_inds, :][:, known_inds]
+            Kab = K[known_inds, :][:, unknown_inds]
+        self.weights = _solve(Kaa, Kab, solver=solver, ridge=ridge, rcond=rcond)
+
+    def reconstruct(self, Y):
+        """
+        Reconstruct activity at the unknown locations
+
+        Parameters
+        ----------
+        Y : Numpy.ndarray
+            A samples x known locations matrix of (z-scored) activity
+
+        Returns
+        ----------
+        results : Numpy.ndarray
+            A samples x unknown locations matrix of reconstructed activity
+        """
+        return np.dot(Y, self.weights)
+
+    @classmethod
+    def from_model(cls, mo, locs, solver='pinv', ridge=0, rcond=1e-15):
+        """
+        Get the operator for reconstructing activity at a model's locations from activity at the given locations
+
+        Operators are cached (see clear_operator_cache), keyed by the model's fingerprint (which changes whenever the
+        model's numerator, denominator or locations are replaced) and the electrode locations, so repeated predictions
+        for the same patient reuse the same operator.
+
+        Parameters
+        ----------
+        mo : supereeg.Model
+            Model (which must include the given locations)
+        locs : pandas.DataFrame or Numpy.ndarray
+            Electrode locations
+        solver, ridge, rcond :
+            How to solve the known locations' system (see ReconstructionOperator)
+
+        Returns
+        ----------
+        operator : supereeg.ReconstructionOperator
+            Reconstruction operator for the model and locations
+        """
+        locs = np.round(np.asarray(locs, dtype=np.float64), 3)
+        key = (mo._fingerprint, locs.shape, locs.tobytes(), solver, ridge, rcond)
+
+        operator = _operator_cache.get(key)
+        if operator is None:
+            if mo.eigenvectors is None:
+                K = _z2r(mo.get_model(z_transform=True, copy=False))
+            else:
+                K = (mo.eigenvectors, mo.eigenvalues)
+            known_inds, unknown_inds = known_unknown(mo.get_locs().as_matrix(), locs, locs)
+            operator = cls(K, known_inds, unknown_inds, solver=solver, ridge=ridge, rcond=rcond)
+            _operator_cache.put(key, operator)
+        return operator
+
+
+class OnlinePredictor(object):
+    """
+    Online reconstructions for the supereeg package
+
+    Reconstructs activity at every model location from small blocks (or single
+    samples) of a patient's recordings as they arrive, e.g. for closed-loop
+    experiments.  Everything that doesn't depend on the incoming data (blurring
+    the model out to the patient's electrodes and solving for the
+    reconstruction weights) is done once, when the predictor is created.
+    Each block is then z-scored using running (Welford) estimates of each
+    electrode's mean and standard deviation, and mapped onto the model's
+    locations with a single matrix product.
+
+    Reconstructed activity at the unknown locations is scaled by its standard
+    deviation under the model (sqrt(diag(W' * Kaa * W))), rather than by
+    batch statistics, so each block's output only depends on the data seen so
+    far.
+
+    Parameters
+    ----------
+    mo : supereeg.Model
+        Model used to reconstruct activity (the model itself isn't changed)
+    locs : pandas.DataFrame or Numpy.ndarray
+        Electrode locations, in the same order as the columns of the incoming
+        data
+    mean : Numpy.ndarray or None
+        Initial estimate of each electrode's mean (e.g. from a baseline
+        recording).  If None (default), the running statistics start from the
+        first block.
+    std : Numpy.ndarray or None
+        Initial estimate of each electrode's standard deviation (used with
+        mean)
+    n_init : int
+        Number of samples the initial mean and std are weighted as (default:
+        1000)
+    solver, ridge, rcond :
+        How to solve the electrodes' system (see ReconstructionOperator)
+
+    Attributes
+    ----------
+    locs : pandas.DataFrame
+        Locations of the reconstructed activity (the model's locations and the
+        electrodes' locations)
+    label : list
+        'observed' or 'reconstructed', for each location
+    n_samples : int
+        Number of samples included in the running statistics
+    latency : float
+        Duration (in seconds) of the most recent call to predict
+    latencies : collections.deque
+        Durations of (up to) the last 1000 calls to predict
+    """
+    def __init__(self, mo, locs, mean=None, std=None, n_init=1000, solver='pinv', ridge=0, rcond=1e-15):
+        from .model import Model
+
+        locs = np.asarray(locs, dtype=np.float64)
+        mo = Model(mo)
+        mo.set_locs(locs, force_include_bo_locs=True)
+        operator = ReconstructionOperator.from_model(mo, locs, solver=solver, ridge=ridge, rcond=rcond)
+        assert len(operator.known_inds) == locs.shape[0], 'Electrode locations must be unique'
+
+        #known locations keep their (z-scored) data; unknown locations are scaled to unit variance under the model
+        if mo.eigenvectors is None:
+            Kaa = _z2r(mo.get_model(z_transform=True, copy=False))[operator.known_inds, :][:, operator.known_inds]
+        else:
+            Kaa = _low_rank_corr(mo.eigenvectors[operator.known_inds, :], mo.eigenvalues)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            scale = np.sqrt(np.sum(operator.weights * np.dot(Kaa, operator.weights), axis=0))
+            weights = np.where(scale > 0, np.divide(operator.weights, scale), 0)
+
+        self._weights = np.zeros((len(operator.known_inds), operator.n_locs))
+        self._weights[:, operator.unknown_inds] = weights
+        self._weights[np.arange(len(operator.known_inds)), operator.known_inds] = 1
+
+        self.locs = mo.get_locs()
+        observed = np.zeros(operator.n_locs, dtype=bool)
+        observed[operator.known_inds] = True
+        self.label = _loc_labels(observed)
+
+        if mean is None:
+            self.n_samples = 0
+            self._mean = np.zeros(locs.shape[0])
+            self._m2 = np.zeros(locs.shape[0])
+        else:
+            self.n_samples = n_init
+            self._mean = np.asarray(mean, dtype=np.float64).copy()
+            self._m2 = np.square(np.asarray(std, dtype=np.float64)) * n_init
+
+        self.latency = None
+        self.latencies = deque(maxlen=1000)
+
+    def predict(self, data, update=True):
+        """
+        Reconstruct activity at every model location
+
+        Parameters
+        ----------
+        data : Numpy.ndarray
+            A samples x electrodes block of activity (or a single sample)
+        update : bool
+            If True (default), the block is included in the running mean and
+            standard deviation before it's z-scored.  If False, the current
+            estimates are used as is.
+
+        Returns
+        ----------
+        results : Numpy.ndarray
+            A samples x locations array of reconstructed activity (at the
+            locations in self.locs)
+        """
+        start = _clock()
+        data = np.atleast_2d(np.asarray(data, dtype=np.float64))
+        if update:
+            self._update(data)
+
+        if self.n_samples > 1:
+            std = np.sqrt(self._m2 / self.n_samples)
+            std[std == 0] = 1
+        else:
+            std = np.ones_like(self._mean)
+        results = np.dot((data - self._mean) / std, self._weights)
+
+        self.latency = _clock() - start
+        self.latencies.append(self.latency)
+        return results
+
+    def _update(self, data):
+        """
+        Merge a block of data into the running mean and (summed squared) deviations (Chan et al.'s parallel version of
+        Welford's algorithm)
+        """
+        n = data.shape[0]
+        mean = np.mean(data, axis=0)
+        m2 = np.sum(np.square(data - mean), axis=0)
+        total = self.n_samples + n
+        delta = mean - self._mean
+        self._mean += delta * (n / total)
+        self._m2 += m2 + np.square(delta) * (self.n_samples * n / total)
+        self.n_samples = total
+
+
+def _solve(Kaa, Kab, solver='pinv', ridge=0, rcond=1e-15):
+    """
+    Solve (Kaa + ridge * I) * X = Kab for X (see ReconstructionOperator)
+    """
+    assert solver in ('pinv', 'cholesky', 'eigh'), 'Unsupported solver: ' + str(solver)
+    assert ridge >= 0, 'ridge must be non-negative'
+    if ridge > 0:
+        Kaa = Kaa + ridge * np.eye(Kaa.shape[0])
+
+    if solver == 'cholesky':
+        try:
+            return cho_solve(cho_factor(Kaa, lower=True), Kab)
+        except LinAlgError:
+            warnings.warn('Known locations\' correlation matrix is not positive definite; falling back to pinv.  '
+                          'Consider setting ridge > 0.')
+            solver = 'pinv'
+
+    if solver == 'eigh':
+        vals, vecs = eigh(Kaa)
+        keep = vals > rcond * np.max(np.abs(vals))
+        vecs = vecs[:, keep]
+        return np.dot(vecs, np.divide(np.dot(vecs.T, Kab), vals[keep][:, np.newaxis]))
+
+    return np.dot(np.linalg.pinv(Kaa, rcond=rcond), Kab)
+
+
+def _loo_weights(K, ridge=0, rcond=1e-15):
+    """
+    Leave-one-out reconstruction weights for every location in K
+
+    Column j holds the weights for reconstructing location j from every other
+    location (K[-j, -j]^-1 * K[-j, j], with a 0 for location j itself).  Every
+    column comes from a single inverse, P = K^-1, via the block inverse
+    identity K[-j, -j]^-1 * K[-j, j] = -P[-j, j] / P[j, j], so K is only
+    inverted once.  The ridge is added to the diagonal of K (which is the same
+    as adding it to the diagonal of each K[-j, -j]).
+    """
+    assert ridge >= 0, 'ridge must be non-negative'
+    if ridge > 0:
+        K = K + ridge * np.eye(K.shape[0])
+    P = np.linalg.pinv(K, rcond=rcond)
+    W = -np.divide(P, np.diag(P)[np.newaxis, :])
+    np.fill_diagonal(W, 0)
+    return W
+
+
+def clear_operator_cache():
+    """
+    Discard every cached reconstruction operator
+    """
+    _operator_cache.clear()
@@ -5,6 +5,7 @@ import supereeg as se
 import glob
 from supereeg.helpers import *
 from scipy.stats import kurtosis, zscore
+from scipy.special import logsumexp
 import os
 
 ## don't understand why i have to do this:
@@ -12,7 +13,8 @@ from supereeg.helpers import _std, _gray, _resample_nii, _apply_by_file_index, _
     _log_rbf, \
     _timeseries_recon, _chunker, \
     _corr_column, _normalize_Y, _near_neighbor, _vox_size, _count_overlapping, _resample, \
-    _nifti_to_brain, _brain_to_nifti, _to_log_complex, _to_exp_real, _logsubexp
+    _nifti_to_brain, _brain_to_nifti, _to_log_complex, _to_exp_real, _logsubexp, _blur_corrmat, \
+    _sparse_rbf, _loc_index, _match_index, _pack_triu, _unpack_triu, _packed_take
 from supereeg.model import _recover_model
 
 locs = np.array([[-61., -77.,  -3.],
@@ -147,6 +149,151 @@ def test_log_rbf():
     assert isinstance(weights, np.ndarray)
     assert np.allclose(np.diag(weights), 0)
 
+def _reference_blur_corrmat(Z, weights):
+    #the original (one location pair at a time) implementation of _blur_corrmat
+    triu_inds = np.triu_indices(Z.shape[0], k=1)
+    sign_Z = np.sign(Z)[triu_inds]
+    with np.errstate(divide='ignore'):
+        logZ_pos = np.log(np.multiply(sign_Z > 0, Z[triu_inds]))
+        logZ_neg = np.log(np.multiply(sign_Z < 0, np.abs(Z[triu_inds])))
+
+    n = weights.shape[0]
+    K_pos = np.zeros([n, n])
+    K_neg = np.zeros([n, n])
+    W = np.zeros([n, n])
+    for x in range(n-1):
+        x_match = np.isclose(weights[x, :], 0)
+        for y in range(x+1, n):
+            y_match = np.isclose(weights[y, :], 0)
+            if np.any(x_match) and np.any(y_match):
+                Z_match_val = np.mean(Z[np.where(x_match)[0], np.where(y_match)[0]])
+                if Z_match_val > 0:
+                    K_pos[x, y] = np.log(Z_match_val)
+                    K_neg[x, y] = -np.inf
+                else:
+                    K_pos[x, y] = -np.inf
+                    K_neg[x, y] = np.log(np.abs(Z_match_val))
+                continue
+            next_weights = np.add.outer(weights[x, :], weights[y, :])[triu_inds]
+            W[x, y] = logsumexp(next_weights)
+            K_pos[x, y] = logsumexp(logZ_pos + next_weights)
+            K_neg[x, y] = logsumexp(logZ_neg + next_weights)
+
+    K_neg = np.multiply(0+1j, K_neg)
+    K_neg.real[np.isnan(K_neg)] = 0
+    K = K_pos + K_neg
+    return K + K.T, W + W.T
+
+def test_blur_corrmat_block_size():
+    Z = _r2z(_get_corrmat(data[0]))
+    weights = _log_rbf(locs, data[0].get_locs())
+    num, denom = _blur_corrmat(Z, weights)
+    num_b, denom_b = _blur_corrmat(Z, weights, block_size=3)
+    num_r, denom_r = _reference_blur_corrmat(Z, weights)
+    assert num.shape == (locs.shape[0], locs.shape[0])
+    assert np.allclose(num.real, num_r.real, equal_nan=True)
+    assert np.allclose(num.imag, num_r.imag, equal_nan=True)
+    assert np.allclose(denom, denom_r, equal_nan=True)
+    assert np.allclose(num_b.real, num.real, equal_nan=True)
+    assert np.allclose(num_b.imag, num.imag, equal_nan=True)
+    assert np.allclose(denom_b, denom, equal_nan=True)
+    assert np.allclose(num.real, num.real.T, equal_nan=True)
+
+def test_blur_corrmat_factorized():
+    Z = _r2z(_get_corrmat(data[0]))
+    weights = _log_rbf(locs, data[0].get_locs())
+    num, denom = _blur_corrmat(Z, weights)
+    num_f, denom_f = _blur_corrmat(Z, weights, method='factorized')
+    assert np.allclose(num_f.real, num.real, equal_nan=True)
+    assert np.allclose(num_f.imag, num.imag, equal_nan=True)
+    assert np.allclose(denom_f, denom, equal_nan=True)
+
+def test_blur_corrmat_factorized_isolated():
+    #both target locations are closest to the same isolated source location, so every shifted weight underflows
+    source_locs = np.array([[0., 0., 0.], [130., 0., 0.], [135., 5., 0.]])
+    target_locs = np.array([[1., 0., 0.], [0., 1., 0.], [130., 1., 0.]])
+    Z = _r2z(np.array([[1., .5, .3], [.5, 1., -.2], [.3, -.2, 1.]]))
+    weights = _log_rbf(target_locs, source_locs)
+    num, denom = _blur_corrmat(Z, weights)
+    num_f, denom_f = _blur_corrmat(Z, weights, method='factorized')
+    assert np.all(np.isfinite(denom_f))
+    assert np.allclose(num_f.real, num.real, equal_nan=True)
+    assert np.allclose(num_f.imag, num.imag, equal_nan=True)
+    assert np.allclose(denom_f, denom, equal_nan=True)
+    assert np.isclose(np.exp(num_f.real[0, 1] - denom_f[0, 1]) - np.exp(num_f.imag[0, 1] - denom_f[0, 1]), _r2z(.5))
+
+def test_blur_corrmat_parallel():
+    Z = _r2z(_get_corrmat(data[0]))
+    weights = _log_rbf(locs, data[0].get_locs())
+    num, denom = _blur_corrmat(Z, weights)
+    num_p, denom_p = _blur_corrmat(Z, weights, n_jobs=2)
+    assert np.allclose(num_p.real, num.real, equal_nan=True)
+    assert np.allclose(num_p.imag, num.imag, equal_nan=True)
+    assert np.allclose(denom_p, denom, equal_nan=True)
+
+def test_sparse_rbf():
+    weights = _sparse_rbf(locs, locs[:10], tol=1e-3)
+    dense = np.exp(_log_rbf(locs, locs[:10]))
+    assert weights.shape == dense.shape
+    assert np.allclose(weights.diagonal(), 1)
+    assert np.allclose(weights.toarray()[dense >= 1e-3], dense[dense >= 1e-3])
+    assert np.all(weights.toarray()[dense < 1e-3] == 0)
+
+def test_blur_corrmat_sparse():
+    bo_s = se.simulate_model_bos(n_samples=10, locs=locs, sample_locs=n_elecs, set_random_seed=123)
+    Z = _r2z(_get_corrmat(bo_s))
+    tol = 1e-10
+    #the sparse blur matches the exact blur with the truncated weights set to -inf
+    weights = _log_rbf(locs, bo_s.get_locs())
+    num, denom = _blur_corrmat(Z, np.where(weights >= np.log(tol), weights, -np.inf))
+    num_s, denom_s = _blur_corrmat(Z, _sparse_rbf(locs, bo_s.get_locs(), tol=tol))
+    assert np.allclose(num_s.real, num.real, equal_nan=True)
+    assert np.allclose(num_s.imag, num.imag, equal_nan=True)
+    assert np.allclose(denom_s, denom, equal_nan=True)
+    #pairs of locations with no electrodes within the truncation radius are -inf
+    far = np.all(weights < np.log(tol), axis=1)
+    assert np.any(far)
+    pairs = np.ix_(far, far)
+    off_diagonal = ~np.eye(np.sum(far), dtype=bool)
+    assert np.all(np.isneginf(denom_s[pairs][off_diagonal]))
+    assert np.all(np.isneginf(num_s.real[pairs][off_diagonal]))
+
+def test_blur_corrmat_incremental():
+    Z = _r2z(_get_corrmat(data[0]))
+    weights = _log_rbf(locs, data[0].get_locs())
+    source_inds = _loc_index(data[0].get_locs(), locs)
+    num, denom = _blur_corrmat(Z, weights)
+    num_i, denom_i = _blur_corrmat(Z, weights, source_inds=source_inds)
+    assert np.allclose(num_i.real, num.real, equal_nan=True)
+    assert np.allclose(num_i.imag, num.imag, equal_nan=True)
+    assert np.allclose(denom_i, denom, equal_nan=True)
+    #the factorized and sparse methods only compute products for the new locations
+    num_f, denom_f = _blur_corrmat(Z, weights, method='factorized', source_inds=source_inds)
+    assert np.allclose(num_f.real, num.real, equal_nan=True)
+    assert np.allclose(num_f.imag, num.imag, equal_nan=True)
+    assert np.allclose(denom_f, denom, equal_nan=True)
+    sparse_weights = _sparse_rbf(locs, data[0].get_locs())
+    num_s, denom_s = _blur_corrmat(Z, sparse_weights)
+    num_si, denom_si = _blur_corrmat(Z, sparse_weights, source_inds=source_inds)
+    assert np.allclose(num_si.real, num_s.real, equal_nan=True)
+    assert np.allclose(num_si.imag, num_s.imag, equal_nan=True)
+    assert np.allclose(denom_si, denom_s, equal_nan=True)
+
+def test_match_index():
+    match_src, multi_matches = _match_index(_log_rbf(locs, locs[6:]))
+    assert np.array_equal(match_src, np.concatenate([-np.ones(6), np.arange(6)]))
+    assert multi_matches == {}
+    sparse_src, sparse_multi = _match_index(_sparse_rbf(locs, locs[6:]))
+    assert np.array_equal(sparse_src, match_src)
+
+def test_pack_triu():
+    Z = _r2z(_get_corrmat(data[0]))
+    packed = _pack_triu(Z)
+    assert packed.shape == (Z.shape[0] * (Z.shape[0] + 1) // 2,)
+    assert np.array_equal(_unpack_triu(packed), Z)
+    inds = np.array([3, 0, 2])
+    assert np.array_equal(_unpack_triu(_packed_take(packed, inds)), Z[inds, :][:, inds])
+
 def test_tal2mni():
     tal_vals = tal2mni(locs)
     assert isinstance(tal_vals, np.ndarray)
@@ -189,6 +336,78 @@ def test_model_compile(tmpdir):
     assert np.allclose(mo.numerator.imag, test_model.numerator.imag, equal_nan=True)
     assert np.allclose(mo.denominator, test_model.denominator, equal_nan=True)
 
+def test_model_compile_parallel(tmpdir):
+    p = tmpdir.mkdir("sub")
+    for m in range(len(data)):
+        model = se.Model(data=data[m], locs=locs)
+        model.save(fname=os.path.join(p.strpath, str(m)))
+    model_data = glob.glob(os.path.join(p.strpath, '*.mo'))
+    mo = model_compile(model_data, n_jobs=2)
+    serial = model_compile(model_data)
+    assert mo.n_subs == len(data)
+    assert np.allclose(mo.get_model(), test_model.get_model(), equal_nan=True)
+    assert np.allclose(mo.denominator, serial.denominator, equal_nan=True)
+
+def test_model_build(tmpdir):
+    p = tmpdir.mkdir("sub")
+    for i, b in enumerate(data):
+        b.save(os.path.join(p.strpath, str(i)))
+    mo = model_build(p.strpath, locs=locs, prefetch=1)
+    expected = se.Model(data=data, locs=locs)
+    assert mo.n_subs == len(data)
+    assert np.allclose(mo.get_model(), expected.get_model(), equal_nan=True)
+
+    #an interrupted build resumes from its checkpoint
+    fnames = sorted(glob.glob(os.path.join(p.strpath, '*.bo')))
+    checkpoint = os.path.join(p.strpath, 'build.ckpt')
+    partial = model_build(fnames[:2], locs=locs, checkpoint=checkpoint, checkpoint_every=1)
+    assert partial.n_subs == 2
+    resumed = model_build(fnames, locs=locs, checkpoint=checkpoint)
+    assert resumed.n_subs == len(data)
+    assert np.allclose(resumed.get_model(), expected.get_model(), equal_nan=True)
+
+def test_model_build_cache(tmpdir):
+    p = tmpdir.mkdir("sub")
+    for i, b in enumerate(data):
+        b.save(os.path.join(p.strpath, str(i)))
+    fnames = sorted(glob.glob(os.path.join(p.strpath, '*.bo')))
+    cache_dir = os.path.join(p.strpath, 'cache')
+    mo = model_build(fnames, locs=locs, cache_dir=cache_dir)
+    assert len(glob.glob(os.path.join(cache_dir, '*.npy'))) == 2 * len(data)
+
+    #subsets are assembled from the cached contributions
+    subset = model_build(fnames[1:], locs=locs, cache_dir=cache_dir)
+    assert len(glob.glob(os.path.join(cache_dir, '*.npy'))) == 2 * len(data)
+    assert subset.n_subs == len(data) - 1
+    assert np.allclose(subset.get_model(), model_build(fnames[1:], locs=locs).get_model(), equal_nan=True)
+    assert np.allclose(model_build(fnames, locs=locs, cache_dir=cache_dir).get_model(), mo.get_model(),
+                       equal_nan=True)
+
+def test_model_leave_one_out():
+    models = list(model_leave_one_out(data, locs=locs))
+    assert len(models) == len(data)
+    for i, mo in enumerate(models):
+        expected = se.Model(data=[d for j, d in enumerate(data) if j != i], locs=locs)
+        assert mo.n_subs == len(data) - 1
+        assert mo.meta['stable']
+        assert np.allclose(mo.get_model(), expected.get_model(), equal_nan=True)
+
+def test_model_leave_one_out_expansion_cache(tmpdir):
+    from supereeg.model import set_expansion_cache
+    cache_dir = tmpdir.mkdir('cache').strpath
+    memmap_dir = tmpdir.mkdir('memmap').strpath
+    set_expansion_cache(cache_dir=cache_dir)
+    try:
+        first = [mo.get_model() for mo in model_leave_one_out(data, locs=locs, memmap_dir=memmap_dir)]
+        n_cached = len(glob.glob(os.path.join(cache_dir, '*.npy')))
+        assert n_cached > 0
+        #the second run reuses the cached expansions, and leaves them in place
+        second = [mo.get_model() for mo in model_leave_one_out(data, locs=locs, memmap_dir=memmap_dir)]
+        assert len(glob.glob(os.path.join(cache_dir, '*.npy'))) == n_cached
+        assert all(np.allclose(x, y, equal_nan=True) for x, y in zip(first, second))
+    finally:
+        set_expansion_cache()
+
 def test_timeseries_recon():
     recon = _timeseries_recon(bo, test_model, 2)
     assert isinstance(recon, np.ndarray)
@@ -221,6 +440,11 @@ def test_count_overlapping():
     assert sum(bool_overlap)==bo.get_locs().shape[0]
     assert isinstance(bool_overlap, np.ndarray)
 
+def test_loc_index():
+    inds = _loc_index(bo_full.get_locs(), bo.get_locs())
+    assert np.array_equal(inds, np.arange(6, 12))
+    assert np.all(_loc_index(bo.get_locs(), bo_full.get_locs())[:6] == -1)
+
 def test_resample():
     samp_data, samp_sess, samp_rate = _resample(bo, 8)
     assert isinstance(samp_data, pd.DataFrame)
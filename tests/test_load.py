@@ -148,6 +148,16 @@ def test_model_load_field_locs():
     locs = se.load('example_model', field='locs')
     assert locs.shape[0]==210
 
+def test_model_load_field_numerator(tmpdir):
+    mo = se.Model(data=data, locs=locs)
+    fname = os.path.join(tmpdir.strpath, 'model')
+    mo.save(fname)
+    numerator = se.load(fname + '.mo', field='numerator')
+    denominator = se.load(fname + '.mo', field='denominator')
+    assert numerator.shape == (locs.shape[0], locs.shape[0])
+    assert np.allclose(numerator, mo.numerator, equal_nan=True)
+    assert np.allclose(denominator, mo.denominator, equal_nan=True)
+
 def test_model_load_field_nii_raise_error():
     with pytest.raises(ValueError):
         bo = se.load('example_nifti', field='locs')
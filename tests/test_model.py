@@ -34,6 +34,10 @@ n_elecs = 5
 data = [se.simulate_model_bos(n_samples=10, sample_rate=10, locs=locs, sample_locs = n_elecs,
                               set_random_seed=123, noise=0) for x in range(n_subs)]
 
+# subjects with different locations and data (the subjects above are identical)
+distinct_data = [se.simulate_model_bos(n_samples=10, sample_rate=10, locs=locs, sample_locs = n_elecs,
+                                       set_random_seed=123 + x, noise=0) for x in range(3)]
+
 # test model to compare
 test_model = se.Model(data=data[0:3], locs=locs, rbf_width=20, n_subs=3)
 
@@ -59,6 +63,75 @@ def test_model_predict():
     print(data[0].dur)
     assert isinstance(bo, se.Brain)
 
+def test_model_predict_stream():
+    model = se.Model(data=data[0:2], locs=locs)
+    bo = model.predict(data[0], nearest_neighbor=False)
+    chunks = list(model.predict_stream(data[0], nearest_neighbor=False, chunk_size=3))
+    assert all(chunk.shape[0] <= 3 for session, sample_range, chunk in chunks)
+    assert chunks[-1][1][1] == bo.data.shape[0]
+    assert np.allclose(np.vstack([chunk for session, sample_range, chunk in chunks]), bo.data.as_matrix())
+
+    #compare with an explicit (pinv) reconstruction, z-scored within each session
+    from scipy.stats import zscore
+    bo_locs = data[0].get_locs().as_matrix()
+    model_locs = model.get_locs().as_matrix()
+    known = np.array([np.where(np.all(model_locs == x, axis=1))[0][0] for x in bo_locs])
+    unknown = np.setdiff1d(np.arange(model_locs.shape[0]), known)
+    K = model.get_model()
+    sessions = np.asarray(data[0].sessions)
+    Y = data[0].get_data().as_matrix().astype(np.float64)
+    for s in np.unique(sessions):
+        Y[sessions == s, :] = zscore(Y[sessions == s, :])
+    expected = np.zeros((Y.shape[0], model_locs.shape[0]))
+    expected[:, unknown] = np.dot(Y, np.dot(np.linalg.pinv(K[known, :][:, known]), K[known, :][:, unknown]))
+    expected[:, known] = Y
+    for s in np.unique(sessions):
+        expected[sessions == s, :] = zscore(expected[sessions == s, :])
+    assert np.allclose(np.vstack([chunk for session, sample_range, chunk in chunks]), expected)
+
+def test_model_predict_many(tmpdir):
+    model = se.Model(data=data[0:2], locs=locs)
+    bos = [data[2], data[3].get_slice(sample_inds=range(5))]
+    expected = [se.Model(data=data[0:2], locs=locs).predict(bo, nearest_neighbor=False) for bo in bos]
+    results = model.predict_many(bos, n_jobs=2, nearest_neighbor=False)
+    assert model.locs.shape[0] == locs.shape[0]
+    for bo_p, bo in zip(results, expected):
+        assert np.allclose(bo_p.data.as_matrix(), bo.data.as_matrix())
+    fnames = model.predict_many(bos, save_dir=str(tmpdir), nearest_neighbor=False)
+    assert all(isinstance(se.load(fname), se.Brain) for fname in fnames)
+
+def test_model_predict_save(tmpdir):
+    model = se.Model(data=data[0:2], locs=locs)
+    bo = model.predict(data[0], nearest_neighbor=False)
+    bo_s = model.predict(data[0], nearest_neighbor=False, save=str(tmpdir.join('recon.bo')))
+    assert np.allclose(bo_s.get_slice(sample_inds=[4, 1]).data.as_matrix(), bo.data.as_matrix()[[4, 1], :])
+    assert np.allclose(bo_s.data.as_matrix(), bo.data.as_matrix())
+    assert np.allclose(bo_s.get_locs().as_matrix(), bo.get_locs().as_matrix())
+    assert bo_s.label == bo.label
+
+def test_model_predict_recon_loc_inds():
+    model = se.Model(data=data[0:2], locs=locs)
+    bo = se.Model(data=data[0:2], locs=locs).predict(data[0], nearest_neighbor=False)
+    bo_r = model.predict(data[0], nearest_neighbor=False, recon_loc_inds=[2, 0])
+    assert model.locs.shape[0] == locs.shape[0]
+    assert bo_r.label == ['reconstructed', 'reconstructed']
+    reconstructed = np.where(np.array(bo.label) == 'reconstructed')[0][[2, 0]]
+    assert np.allclose(bo_r.get_locs().as_matrix(), bo.get_locs().as_matrix()[reconstructed])
+    assert np.allclose(bo_r.data.as_matrix(), bo.data.as_matrix()[:, reconstructed])
+
+def test_model_cross_validate():
+    model = se.Model(data=data[0:2], locs=locs)
+    bo = data[2]
+    corrs = model.cross_validate(bo, ridge=0.1)
+    assert model.locs.shape[0] == locs.shape[0]
+    assert corrs.shape == (bo.get_locs().shape[0],)
+    for i in range(bo.get_locs().shape[0]):
+        others = [j for j in range(bo.get_locs().shape[0]) if j != i]
+        bo_p = se.Model(model).predict(bo.get_slice(loc_inds=others), nearest_neighbor=False, ridge=0.1)
+        ind = np.where(np.all(np.isclose(bo_p.get_locs().as_matrix(), bo.get_locs().as_matrix()[i]), axis=1))[0][0]
+        expected = scipy.stats.pearsonr(bo_p.data.as_matrix()[:, ind], bo.get_zscore_data()[:, i])[0]
+        assert np.isclose(corrs[i], expected)
+
 def test_model_predict_nn():
     print(data[0].dur)
     model = se.Model(data=data[0:2], locs=locs)
@@ -77,6 +150,101 @@ def test_model_predict_nn_0():
     assert isinstance(bo_1, se.Brain)
     assert np.allclose(bo_1.get_data(), bo_2.get_data())
 
+def test_create_model_factorized():
+    model = se.Model(data=data[0:2], locs=locs)
+    model_f = se.Model(data=data[0:2], locs=locs, blur_method='factorized')
+    assert model_f.blur_method == 'factorized'
+    assert np.allclose(model.get_model(), model_f.get_model(), equal_nan=True)
+
+def test_create_model_parallel():
+    model = se.Model(data=distinct_data, locs=locs, rbf_width=20, n_subs=3, n_jobs=2)
+    serial = se.Model(data=distinct_data, locs=locs, rbf_width=20, n_subs=3)
+    assert np.allclose(model.get_model(), serial.get_model(), equal_nan=True)
+    assert np.allclose(model.denominator, serial.denominator, equal_nan=True)
+    assert model.n_subs == serial.n_subs
+
+def test_create_model_parallel_memmap(tmpdir):
+    #subjects with an electrode at every model location aren't blurred, so their models aren't memory-mapped
+    full = [se.simulate_model_bos(n_samples=10, sample_rate=10, locs=locs, set_random_seed=123 + x, noise=0)
+            for x in range(3)]
+    model = se.Model(data=full, locs=locs, n_jobs=2, memmap_dir=tmpdir.strpath)
+    serial = se.Model(data=full, locs=locs)
+    assert np.allclose(model.get_model(), serial.get_model(), equal_nan=True)
+    assert np.allclose(model.denominator, serial.denominator, equal_nan=True)
+
+def test_create_model_memmap(tmpdir):
+    model = se.Model(data=data[0], locs=locs)
+    model_m = se.Model(data=data[0], locs=locs, memmap_dir=tmpdir.strpath)
+    assert isinstance(model_m._numerator, np.memmap)
+    assert isinstance(model_m._denominator, np.memmap)
+    assert np.allclose(model.get_model(), model_m.get_model(), equal_nan=True)
+
+def test_model_memmap_files(tmpdir):
+    import gc
+    import glob
+    import os
+    model_m = se.Model(data=data[0], locs=locs, memmap_dir=tmpdir.strpath)
+    for bo in data[1:]:
+        model_m.update(bo)
+    model_m.update(data[1:3])
+    assert isinstance(model_m._numerator, np.memmap)
+    assert isinstance(model_m._denominator, np.memmap)
+    #replaced backing files (and expansions, which aren't cached for memory-mapped models) are deleted once nothing
+    #uses them
+    gc.collect()
+    assert len(glob.glob(os.path.join(tmpdir.strpath, '*.npy'))) == 2
+
+def test_model_reduce(tmpdir):
+    model = se.Model(data=data[0:2], locs=locs)
+    reduced = model.reduce(rank=locs.shape[0])
+    assert reduced.numerator is None
+    assert reduced.eigenvectors.shape[0] == locs.shape[0]
+    assert np.allclose(reduced.get_model(), model.get_model())
+    bo = se.Model(model).predict(data[2], nearest_neighbor=False)
+    bo_r = reduced.predict(data[2], nearest_neighbor=False)
+    assert np.allclose(bo_r.data.as_matrix(), bo.data.as_matrix())
+    reduced_ev = model.reduce(explained_variance=0.5)
+    assert reduced_ev.eigenvalues.shape[0] < reduced.eigenvalues.shape[0]
+    assert np.sum(reduced_ev.eigenvalues) >= 0.5 * locs.shape[0]
+    reduced_ev.save(tmpdir.join('reduced.mo').strpath)
+    mo = se.load(tmpdir.join('reduced.mo').strpath)
+    assert np.allclose(mo.eigenvectors, reduced_ev.eigenvectors)
+    with pytest.raises(ValueError):
+        reduced.update(data[3])
+
+def test_model_expansion_cache(tmpdir):
+    from supereeg.model import set_expansion_cache, clear_expansion_cache
+    set_expansion_cache(cache_dir=tmpdir.strpath)
+    try:
+        model = se.Model(data=data[0:2], locs=locs)
+        expansion = model._blur(data[3].get_locs().as_matrix(), width=20)
+        assert model._blur(data[3].get_locs().as_matrix(), width=20) is expansion
+        clear_expansion_cache()
+        reloaded = se.Model(model)._blur(data[3].get_locs().as_matrix(), width=20)
+        assert reloaded is not expansion
+        assert all(np.array_equal(x, y) for x, y in zip(expansion, reloaded))
+    finally:
+        set_expansion_cache()
+
+def test_create_model_float32(tmpdir):
+    model = se.Model(data=data[0], locs=locs)
+    model_f = se.Model(data=data[0], locs=locs, precision='float32')
+    assert model_f.numerator.dtype == np.complex64
+    assert model_f.denominator.dtype == np.float32
+    assert np.allclose(model.get_model(), model_f.get_model(), atol=1e-5)
+    model_f.save(tmpdir.join('model_f.mo').strpath)
+    mo = se.load(tmpdir.join('model_f.mo').strpath)
+    assert mo.precision == 'float32'
+    assert mo.numerator.dtype == np.complex64
+
+def test_model_packed():
+    model = se.Model(data=data[0], locs=locs)
+    assert model._numerator.shape == (locs.shape[0] * (locs.shape[0] + 1) // 2,)
+    assert model.numerator.shape == (locs.shape[0], locs.shape[0])
+    assert np.allclose(model.numerator.real, model.numerator.real.T, equal_nan=True)
+    mo = se.Model(numerator=model.numerator, denominator=model.denominator, locs=model.locs)
+    assert np.allclose(mo.get_model(), model.get_model())
+
 def test_update():
     model = se.Model(data=data[1:3], locs=locs)
     mo = se.Model([model, data[0]])
@@ -120,6 +288,19 @@ def test_model_update_with_array():
     mo = se.Model([mo, d], locs=mo.get_locs())
     assert isinstance(mo, se.Model)
 
+def test_model_update_with_list():
+    mo = se.Model(data=distinct_data[0], locs=locs)
+    sequential = mo.update(distinct_data[1], inplace=False)
+    sequential.update(distinct_data[2])
+    bulk = mo.update(distinct_data[1:], inplace=False)
+    assert bulk.n_subs == sequential.n_subs == 3
+    assert np.allclose(bulk.get_model(), sequential.get_model(), equal_nan=True)
+    assert np.allclose(bulk.denominator, sequential.denominator, equal_nan=True)
+    assert np.allclose((mo + distinct_data[1:]).get_model(), bulk.get_model(), equal_nan=True)
+    #updating with one of the subjects twice gives a different model
+    repeated = mo.update([distinct_data[1], distinct_data[1]], inplace=False)
+    assert not np.allclose(repeated.get_model(), bulk.get_model(), equal_nan=True)
+
 #This syntax is ambiguous and no longer supported
 #def test_model_update_with_smaller_array():
 #    mo = se.Model(data=data[1:3], locs=locs)
@@ -127,11 +308,32 @@ def test_model_update_with_array():
 #    with pytest.raises(ValueError):
 #        mo = se.Model([mo, d])
 
+def test_model_numerator_read_only():
+    mo = se.Model(data=data[1:3], locs=locs)
+    with pytest.raises(ValueError):
+        mo.numerator[0, 1] = 0
+    with pytest.raises(ValueError):
+        mo.denominator[0, 1] = 0
+    numerator = np.array(mo.numerator)
+    numerator[0, 1] = numerator[1, 0] = 0
+    mo.numerator = numerator
+    assert mo.numerator[0, 1] == 0
+
 def test_model_get_model():
     mo = se.Model(data=data[1:3], locs=locs)
     m = mo.get_model()
     assert isinstance(m, np.ndarray)
 
+def test_model_get_model_cache():
+    mo = se.Model(data=distinct_data[0], locs=locs)
+    view = mo.get_model(copy=False)
+    assert not view.flags.writeable
+    m = mo.get_model()
+    m[0, 1] = 2
+    assert mo.get_model()[0, 1] != 2
+    mo.update(distinct_data[1])
+    assert not np.allclose(mo.get_model(), view, equal_nan=True)
+
 def test_model_get_slice():
     mo = se.Model(data=data[1:3], locs=locs)
     inds = [0, 1]
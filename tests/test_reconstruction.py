@@ -0,0 +1,111 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function
+import supereeg as se
+import numpy as np
+import pytest
+from supereeg.cache import LRUCache
+from supereeg.reconstruction import clear_operator_cache
+
+locs = np.array([[-61., -77.,  -3.],
+                 [-41., -77., -23.],
+                 [-21., -97.,  17.],
+                 [-21., -37.,  77.],
+                 [-21.,  63.,  -3.],
+                 [ -1., -37.,  37.],
+                 [ -1.,  23.,  17.],
+                 [ 19., -57., -23.],
+                 [ 19.,  23.,  -3.],
+                 [ 39., -57.,  17.],
+                 [ 39.,   3.,  37.],
+                 [ 59., -17.,  17.]])
+
+n_elecs = 5
+data = [se.simulate_model_bos(n_samples=10, sample_rate=10, locs=locs, sample_locs=n_elecs,
+                              set_random_seed=123, noise=0) for x in range(3)]
+test_model = se.Model(data=data[1:3], locs=locs)
+
+
+def test_lru_cache():
+    cache = LRUCache(maxsize=2)
+    cache.put('a', 1)
+    cache.put('b', 2)
+    assert cache.get('a') == 1
+    cache.put('c', 3)
+    assert 'a' in cache
+    assert not ('b' in cache)
+    assert cache.get('b') is None
+    assert len(cache) == 2
+    cache.clear()
+    assert len(cache) == 0
+
+def test_lru_cache_maxbytes():
+    cache = LRUCache(maxsize=None, maxbytes=2000)
+    cache.put('a', (np.zeros(100), np.zeros(50)))
+    cache.put('b', np.zeros(100))
+    assert cache.nbytes == 2000
+    cache.get('a')
+    cache.put('c', np.zeros(50))
+    assert 'a' in cache
+    assert not ('b' in cache)
+    cache.put('d', np.zeros(1000))
+    assert not ('d' in cache)
+    assert cache.nbytes == 1600
+
+def test_operator_from_model():
+    clear_operator_cache()
+    operator = se.ReconstructionOperator.from_model(test_model, data[0].get_locs())
+    assert isinstance(operator, se.ReconstructionOperator)
+    assert operator.weights.shape == (len(operator.known_inds), len(operator.unknown_inds))
+    assert operator.n_locs == locs.shape[0]
+    assert se.ReconstructionOperator.from_model(test_model, data[0].get_locs()) is operator
+
+def test_operator_reconstruct():
+    K = test_model.get_model()
+    operator = se.ReconstructionOperator(K, [0, 1, 2], list(range(3, locs.shape[0])))
+    Y = data[0].get_zscore_data()[:, :3]
+    Kaa = K[[0, 1, 2], :][:, [0, 1, 2]]
+    Kba = K[3:, :][:, [0, 1, 2]]
+    assert np.allclose(operator.reconstruct(Y), np.dot(np.dot(Kba, np.linalg.pinv(Kaa)), Y.T).T)
+
+def test_operator_cache_invalidated():
+    operator = se.ReconstructionOperator.from_model(test_model, data[0].get_locs())
+    mo = se.Model(data=data[1:3], locs=locs)
+    mo.update(data[0])
+    assert not (se.ReconstructionOperator.from_model(mo, data[0].get_locs()) is operator)
+
+@pytest.mark.parametrize('solver', ['cholesky', 'eigh'])
+def test_operator_solvers(solver):
+    K = test_model.get_model()
+    known_inds, unknown_inds = [0, 1, 2], list(range(3, locs.shape[0]))
+    operator = se.ReconstructionOperator(K, known_inds, unknown_inds)
+    operator_s = se.ReconstructionOperator(K, known_inds, unknown_inds, solver=solver)
+    assert np.allclose(operator_s.weights, operator.weights)
+
+def test_operator_ridge():
+    K = test_model.get_model()
+    known_inds, unknown_inds = [0, 1, 2], list(range(3, locs.shape[0]))
+    operator = se.ReconstructionOperator(K, known_inds, unknown_inds, solver='cholesky', ridge=0.1)
+    Kaa = K[known_inds, :][:, known_inds] + 0.1 * np.eye(3)
+    Kab = K[known_inds, :][:, unknown_inds]
+    assert np.allclose(operator.weights, np.linalg.solve(Kaa, Kab))
+
+def test_online_predictor():
+    predictor = se.OnlinePredictor(test_model, data[0].get_locs())
+    bo = se.Model(test_model).predict(data[0], nearest_neighbor=False)
+    recon = predictor.predict(data[0].get_data().as_matrix())
+    assert recon.shape == bo.data.shape
+    assert predictor.label == bo.label
+    assert len(predictor.latencies) == 1
+    observed = np.array(predictor.label) == 'observed'
+    assert np.allclose(recon[:, observed], bo.data.as_matrix()[:, observed])
+    assert np.allclose(recon[:, ~observed] / np.std(recon[:, ~observed], axis=0), bo.data.as_matrix()[:, ~observed])
+
+def test_online_predictor_blocks():
+    predictor = se.OnlinePredictor(test_model, data[0].get_locs())
+    X = data[0].get_data().as_matrix()
+    for start in range(0, X.shape[0], 3):
+        assert predictor.predict(X[start:(start + 3)]).shape[0] == min(3, X.shape[0] - start)
+    assert predictor.n_samples == X.shape[0]
+    assert np.allclose(predictor._mean, np.mean(X, axis=0))
+    assert np.allclose(np.sqrt(predictor._m2 / predictor.n_samples), np.std(X, axis=0))